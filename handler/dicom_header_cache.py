@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""
+Persistent, content-addressed cache of parsed DICOM header tags.
+
+find_img_data.py and presort_dicoms.py only need a handful of tags from each DICOM file. Users
+frequently re-upload the same series (e.g. retrying after a failed finalize, or uploading overlapping
+batches), so the parsed tags are stored in a SQLite file shared by all sessions. Entries are keyed on
+the file size, mtime and a hash of the first few KB of the file, and the least recently used entries
+are evicted once the cache grows past its size limit. The cache outlives the sessions, so tags that
+identify a patient (identifying_tags) are never stored: they are parsed from the file every time.
+
+The cache location is set with the DICOM_HEADER_CACHE environment variable (an empty value disables
+caching) and its size limit, in MB, with DICOM_HEADER_CACHE_MB.
+"""
+
+import os
+import sys
+import sqlite3
+import hashlib
+import threading
+from pydicom import dcmread
+
+# the cache directory is defined alongside the analyzer's caches
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ezBIDS_core'))
+from cache_store import cache_file, LRUStore  # noqa: E402
+
+cache_path = os.getenv('DICOM_HEADER_CACHE', cache_file('dicom_headers.sqlite'))
+cache_max_bytes = int(os.getenv('DICOM_HEADER_CACHE_MB', '512')) * 1024 * 1024
+
+# number of leading bytes hashed into the cache key, enough to cover the preamble and file meta information
+key_head_bytes = 4096
+
+# patient identifiers and dates, never written to the cache (it's kept after the sessions are deleted)
+identifying_tags = ('PatientID', 'PatientName', 'PatientBirthDate', 'PatientAge', 'StudyDate', 'SeriesDate',
+                    'AcquisitionDate', 'AcquisitionDateTime', 'StudyTime')
+
+
+def read_header_tags(file_path, tags):
+    '''
+    Reads the preamble/DICM magic of a file and, if it is a DICOM, only the requested header tags.
+    Pixel data and tags that aren't requested are never read.
+
+    Parameters
+    ----------
+    file_path : string
+        path to the candidate DICOM file
+
+    tags : list
+        DICOM keywords to parse from the header
+
+    Returns
+    -------
+    header : dictionary or None
+        requested keyword -> string value (None if the tag is absent), None if the file isn't a DICOM
+
+    bytes_read : int
+        Number of bytes of the file that were consumed
+    '''
+    with open(file_path, 'rb') as fp:
+        preamble = fp.read(132)
+        if len(preamble) < 132 or preamble[128:132] != b'DICM':
+            return None, len(preamble)
+        fp.seek(0)
+        ds = dcmread(fp, stop_before_pixels=True, specific_tags=list(tags))
+        header = {tag: (str(ds.get(tag)) if tag in ds else None) for tag in tags}
+        return header, fp.tell()
+
+
+class DicomHeaderCache:
+    '''
+    Parsed DICOM header tags, stored in the shared LRUStore (see cache_store.py). A single instance may be
+    shared between threads.
+    '''
+
+    def __init__(self, path=cache_path, max_bytes=cache_max_bytes):
+        self.store = LRUStore(path, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def file_key(file_path):
+        '''
+        Content address of a file: its size, mtime and a hash of its first key_head_bytes bytes.
+        '''
+        st = os.stat(file_path)
+        with open(file_path, 'rb') as fp:
+            digest = hashlib.sha1(fp.read(key_head_bytes)).hexdigest()
+        return f'{st.st_size}-{st.st_mtime_ns}-{digest}'
+
+    def get(self, key, tags):
+        '''
+        Returns (True, header) if every requested tag is cached for key, (False, cached tags) otherwise.
+        A cached header of None means the file isn't a DICOM. If the cache can't be read, it's a miss.
+        '''
+        found, cached = self.store.get(key)
+        hit = found and (cached is None or all(tag in cached for tag in tags))
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            return False, cached or {}
+        if cached is None:
+            return True, None
+        return True, {tag: cached[tag] for tag in tags}
+
+    def put(self, key, header):
+        if header is not None:
+            header = {tag: value for tag, value in header.items() if tag not in identifying_tags}
+            if not len(header):
+                # nothing left worth a cache entry, only "not a DICOM" (None) entries are kept without tags
+                return
+        self.store.put(key, header)
+
+    def read(self, file_path, tags):
+        '''
+        Same as read_header_tags, but served from the cache when possible. bytes_read includes the bytes
+        read to compute the cache key. Requests for identifying_tags are always misses, unless the file is
+        known not to be a DICOM.
+        '''
+        key = self.file_key(file_path)
+        key_bytes_read = min(key_head_bytes, os.path.getsize(file_path))
+        hit, header = self.get(key, tags)
+        if hit:
+            return header, key_bytes_read
+        # parse the union of the requested and previously cached tags so the entry keeps growing
+        all_tags = list(dict.fromkeys(list(tags) + list(header)))
+        parsed, bytes_read = read_header_tags(file_path, all_tags)
+        self.put(key, parsed)
+        if parsed is None:
+            return None, key_bytes_read + bytes_read
+        return {tag: parsed[tag] for tag in tags}, key_bytes_read + bytes_read
+
+    def close(self):
+        self.store.close()
+
+
+def open_cache():
+    '''
+    Opens the shared header cache, or returns None if caching is disabled or the cache can't be used.
+    '''
+    if not cache_path:
+        return None
+    try:
+        return DicomHeaderCache()
+    except (OSError, sqlite3.Error) as e:
+        print(f'DICOM header cache unavailable ({cache_path}): {e}')
+        return None
+
+
+def read_header(file_path, tags, cache=None):
+    '''
+    Reads the requested tags of a DICOM file, through the cache if one is given. See read_header_tags.
+    Requests for identifying_tags only are never cached, so they bypass the cache altogether rather than
+    paying for a cache key and a lookup that always misses.
+    '''
+    if cache is None or all(tag in identifying_tags for tag in tags):
+        return read_header_tags(file_path, tags)
+    return cache.read(file_path, tags)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+Compiled, cached copy of the parts of the BIDS schema used by ezBIDS_core.py.
+
+Parsing the schema YAML files takes a noticeable amount of time every time the analyzer starts, so the
+files are parsed once and the result is stored as JSON (never pickled, loading a tampered cache must not
+run code). The cache is keyed on a hash of the schema files it was compiled from and is rebuilt whenever
+any of them change (e.g. when bids-specification is updated).
+All callers share the single in-memory copy returned by load_schema().
+
+The cache location is set with the BIDS_SCHEMA_CACHE environment variable (an empty value disables
+the on-disk cache). Running this file with the schema directory as argument (re)builds the cache.
+"""
+
+import os
+import sys
+import json
+import hashlib
+from pathlib import Path
+
+import yaml
+from cache_store import cache_file
+
+cache_path = os.getenv('BIDS_SCHEMA_CACHE', cache_file('bids_schema.json'))
+
+# bump when the layout of the compiled schema changes, so stale caches are rebuilt
+cache_version = 2
+
+# libyaml is much faster than the pure python loader, only used when the cache needs to be (re)built
+yaml_loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+schema_files = {
+    'datatypes': 'objects/datatypes.yaml',
+    'entities': 'objects/entities.yaml',
+    'suffixes': 'objects/suffixes.yaml',
+    'dataset_metadata': 'rules/dataset_metadata.yaml',
+    'entity_ordering': 'rules/entities.yaml',
+}
+datatype_rules_dir = 'rules/datatypes'
+
+_schema = None
+_schema_hash = None
+
+
+def list_schema_files(schema_dir):
+    '''
+    Returns the schema files (relative to schema_dir) the compiled schema is built from.
+    '''
+    rule_files = sorted(
+        str(Path(datatype_rules_dir) / x.name) for x in (Path(schema_dir) / datatype_rules_dir).glob('*.yaml')
+    )
+    return list(schema_files.values()) + rule_files
+
+
+def schema_hash(schema_dir, files):
+    '''
+    Hash of the names and contents of the schema files, along with the cache version.
+    '''
+    digest = hashlib.sha1(str(cache_version).encode())
+    for file in files:
+        digest.update(file.encode())
+        digest.update((Path(schema_dir) / file).read_bytes())
+    return digest.hexdigest()
+
+
+def compile_schema(schema_dir, files):
+    '''
+    Parses the schema YAML files.
+
+    Parameters
+    ----------
+    schema_dir : string
+        path to bids-specification/src/schema
+
+    files : list
+        schema files to parse, as returned by list_schema_files
+
+    Returns
+    -------
+    schema : dictionary
+        one entry per key of schema_files, plus "datatype_rules", mapping each datatype to its
+        parsed rules/datatypes/<datatype>.yaml
+    '''
+    def parse(file):
+        with open(Path(schema_dir) / file) as f:
+            return yaml.load(f, Loader=yaml_loader)
+
+    schema = {key: parse(file) for key, file in schema_files.items()}
+    schema['datatype_rules'] = {
+        Path(file).stem: parse(file) for file in files if file.startswith(datatype_rules_dir)
+    }
+    return schema
+
+
+def load_schema(schema_dir):
+    '''
+    Returns the compiled schema, loading it from the cache when it is up to date and compiling
+    (and caching) it otherwise. Subsequent calls return the same object, which must not be modified.
+
+    Parameters
+    ----------
+    schema_dir : string
+        path to bids-specification/src/schema
+
+    Returns
+    -------
+    schema : dictionary
+        see compile_schema
+    '''
+    global _schema, _schema_hash
+    if _schema is not None:
+        return _schema
+
+    files = list_schema_files(schema_dir)
+    key = schema_hash(schema_dir, files)
+    _schema_hash = key
+
+    if cache_path:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                _schema = cached['schema']
+                return _schema
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    _schema = compile_schema(schema_dir, files)
+
+    if cache_path:
+        try:
+            data = json.dumps({'key': key, 'schema': _schema})
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            # write then rename, so concurrent sessions never read a partial cache
+            tmp_path = f'{cache_path}.{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, cache_path)
+        except (OSError, TypeError) as e:
+            print(f'Unable to write BIDS schema cache ({cache_path}): {e}')
+
+    return _schema
+
+
+def loaded_schema_hash():
+    '''
+    Returns the hash (see schema_hash) of the schema files the schema returned by load_schema was compiled from,
+    or None if load_schema hasn't been called.
+    '''
+    return _schema_hash
+
+
+if __name__ == '__main__':
+    load_schema(sys.argv[1])
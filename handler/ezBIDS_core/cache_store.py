@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Location of the caches ezBIDS keeps across sessions (DICOM headers, BIDS schema, Cognitive Atlas tasks,
+series classifications), and the SQLite store used by the ones that are key/value lookups.
+
+The caches are shared by every session, but they must not live in the workdir (/tmp): the API writes
+uploaded files anywhere under it, so an upload could overwrite a cache. They are kept in EZBIDS_CACHE_DIR
+instead, which defaults to /var/cache/ezbids. Each cache file can still be moved (or disabled) on its own
+with its environment variable, see the modules using it.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+cache_dir = os.getenv('EZBIDS_CACHE_DIR', '/var/cache/ezbids')
+
+# seconds a session waits for another one to release the database before giving up on the cache
+lock_timeout = 5
+
+
+def cache_file(name):
+    '''
+    Returns the path of the cache file called name, in the cache directory.
+    '''
+    return os.path.join(cache_dir, name)
+
+
+class LRUStore:
+    '''
+    JSON values stored by key in a SQLite file that concurrent sessions share. The least recently used
+    entries are evicted once the stored values take more than max_bytes.
+
+    Every statement is committed as soon as it runs, so a session never keeps the database locked. If the
+    database can't be used (e.g. it stays locked for more than lock_timeout seconds), the store is disabled
+    for the rest of the session: lookups miss and values aren't stored, the caller just runs without
+    the cache. A single instance may be shared between threads.
+
+    Parameters
+    ----------
+    path : string
+        SQLite file, created if it doesn't exist
+
+    max_bytes : int
+        size limit of the stored keys and values
+    '''
+
+    def __init__(self, path, max_bytes, timeout=lock_timeout):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+
+    @property
+    def enabled(self):
+        return self.connection is not None
+
+    def disable(self, error):
+        '''
+        Stops using the database after an error, see the class description.
+        '''
+        print(f'Cache {self.path} disabled for this session: {error}')
+        try:
+            self.connection.close()
+        except sqlite3.Error:
+            pass
+        self.connection = None
+
+    def get(self, key):
+        '''
+        Returns (True, value) if key is stored, (False, None) otherwise.
+        '''
+        with self.lock:
+            if self.connection is None:
+                return False, None
+            try:
+                row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return False, None
+                self.connection.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+                return True, json.loads(row[0])
+            except sqlite3.Error as e:
+                self.disable(e)
+                return False, None
+
+    def put(self, key, value):
+        value = json.dumps(value)
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                    (key, value, len(key) + len(value), time.time())
+                )
+            except sqlite3.Error as e:
+                self.disable(e)
+
+    def evict(self):
+        '''
+        Drops the least recently used entries until the store fits in max_bytes, in a single statement.
+        '''
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.execute(
+                    'DELETE FROM entries WHERE key IN ('
+                    'SELECT key FROM ('
+                    'SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS kept FROM entries'
+                    ') WHERE kept > ?)',
+                    (self.max_bytes,)
+                )
+            except sqlite3.Error as e:
+                self.disable(e)
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
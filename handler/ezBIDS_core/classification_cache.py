@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+Persistent cache of the series classifications made by ezBIDS_core.py.
+
+Sites upload the same scanner protocols over and over, and the datatype/suffix and entity label heuristics
+give the same answers for them every time. The results are stored, per protocol signature, in a SQLite file
+shared by all sessions. Every entry is also keyed on a namespace, a hash of the BIDS schema and of the
+heuristics themselves (the analyzer source and the Cognitive Atlas task vocabulary), so entries are never
+reused once either changes. The least recently used entries are evicted once the cache grows past its
+size limit.
+
+The cache location is set with the CLASSIFICATION_CACHE environment variable (an empty value disables
+caching) and its size limit, in MB, with CLASSIFICATION_CACHE_MB.
+"""
+
+import os
+import sqlite3
+import hashlib
+from cache_store import cache_file, LRUStore
+
+cache_path = os.getenv('CLASSIFICATION_CACHE', cache_file('classification.sqlite'))
+cache_max_bytes = int(os.getenv('CLASSIFICATION_CACHE_MB', '64')) * 1024 * 1024
+
+
+def cache_namespace(*parts):
+    '''
+    Hash of everything the cached classifications depend on besides the protocol signature.
+
+    Parameters
+    ----------
+    parts : strings or bytes
+        e.g. the BIDS schema hash and the source of the heuristics
+
+    Returns
+    -------
+    namespace : string
+    '''
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ClassificationCache:
+    '''
+    Classification results, stored in the shared LRUStore (see cache_store.py). See ClassificationMemo in
+    ezBIDS_core.py. If the database is locked by another session for too long, the cache is disabled and
+    every lookup misses, the analyzer then classifies the series itself.
+    '''
+
+    def __init__(self, namespace, path=cache_path, max_bytes=cache_max_bytes):
+        self.namespace = namespace
+        self.store = LRUStore(path, max_bytes)
+
+    def key(self, stage, signature):
+        return hashlib.sha1(f'{self.namespace}\0{stage}\0{signature}'.encode()).hexdigest()
+
+    def get(self, stage, signature):
+        '''
+        Returns the result cached for signature by stage, or None.
+        '''
+        found, result = self.store.get(self.key(stage, signature))
+        return result if found else None
+
+    def put(self, stage, signature, result):
+        self.store.put(self.key(stage, signature), result)
+
+    def close(self):
+        self.store.close()
+
+
+def open_cache(namespace):
+    '''
+    Opens the shared classification cache, or returns None if caching is disabled or the cache can't be used.
+    '''
+    if not cache_path:
+        return None
+    try:
+        return ClassificationCache(namespace)
+    except (OSError, sqlite3.Error) as e:
+        print(f'Classification cache unavailable ({cache_path}): {e}')
+        return None
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Offline copy of the Cognitive Atlas task vocabulary, used by ezBIDS_core.py to identify task names.
+
+The analyzer never queries cognitiveatlas.org itself. Task names come from whichever is more recent of:
+    - the versioned snapshot committed to the repository (cognitiveatlas/tasks.json), so building the
+      image doesn't need the network either
+    - the local cache (COG_ATLAS_CACHE), refreshed in the background once it is older than
+      COG_ATLAS_CACHE_TTL_DAYS. Set COG_ATLAS_REFRESH to "false" on hosts without internet access.
+
+Running this file downloads the vocabulary: python3 cog_atlas.py [output file, defaults to the cache].
+python3 cog_atlas.py --snapshot refreshes the committed snapshot (and bumps its version) instead.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+from pathlib import Path
+from datetime import datetime, timezone
+from urllib.request import urlopen
+from cache_store import cache_file
+
+cog_atlas_url = "http://cognitiveatlas.org/api/v-alpha/task"
+
+snapshot_path = str(Path(__file__).resolve().parents[2] / Path("cognitiveatlas/tasks.json"))
+
+cache_path = os.getenv("COG_ATLAS_CACHE", cache_file("cog_atlas_tasks.json"))
+cache_ttl = float(os.getenv("COG_ATLAS_CACHE_TTL_DAYS", "30")) * 24 * 60 * 60
+refresh_enabled = bool(os.getenv("COG_ATLAS_REFRESH", "true").lower() == "true")
+
+
+def normalize_task_names(names):
+    """
+    Turns Cognitive Atlas task names into terms that can be searched for in SeriesDescription.
+
+    Parameters
+    ----------
+    names : list
+        task names, as listed by the Cognitive Atlas API.
+
+    Returns
+    -------
+    tasks : list
+        list of all possible task names. Each task name has spaces, "task", and
+        "test" removed, to make it easier to search the SeriesDescription
+        fields for a matching task name.
+    """
+    # Remove non-alphanumeric terms and "task", "test" substrings
+    tasks = [re.sub("[^A-Za-z0-9]+", "", re.split(" task| test", x)[0]).lower() for x in names]
+    # Remove empty task name terms and ones under 2 characters (b/c hard to detect in SeriesDescription)
+    tasks = [x for x in tasks if len(x) > 2]
+    tasks = sorted(tasks, key=str.casefold)  # sort alphabetically, but ignore case
+
+    return tasks
+
+
+class TaskMatcher:
+    """
+    Finds which task name occurs in a piece of text, in a single scan of the text. When several task names
+    occur, the one listed first in tasks wins, i.e. the same result as searching for each task name in turn.
+
+    Parameters
+    ----------
+    tasks : list
+        task names, in order of priority (see normalize_task_names).
+    """
+
+    def __init__(self, tasks):
+        self.priority = {}
+        for index, task in enumerate(tasks):
+            self.priority.setdefault(task.lower(), index)
+        self.pattern = None
+        if len(self.priority):
+            # the lookahead reports every (possibly overlapping) start position, at each of them the
+            # alternation picks the first listed task name that matches there
+            self.pattern = re.compile(
+                "(?=(" + "|".join(re.escape(x) for x in self.priority) + "))", re.IGNORECASE
+            )
+
+    def first_match(self, text):
+        """
+        Returns the highest priority task name found in text, or None.
+        """
+        if self.pattern is None:
+            return None
+        matches = {x.group(1).lower() for x in self.pattern.finditer(text)}
+        if not len(matches):
+            return None
+        return min(matches, key=self.priority.get)
+
+
+def fetch_vocabulary(url=cog_atlas_url, timeout=60):
+    """
+    Downloads the task names from the Cognitive Atlas API.
+
+    Returns
+    -------
+    vocabulary : dictionary
+        "source" url, "retrieved" (UTC, ISO 8601) and the task "names".
+    """
+    with urlopen(url, timeout=timeout) as url_contents:
+        data = json.load(url_contents)
+    return {
+        "source": url,
+        "retrieved": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "names": [x["name"] for x in data]
+    }
+
+
+def write_vocabulary(vocabulary, path, indent=None):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # write then rename, so the analyzer never reads a partial file
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(vocabulary, f, indent=indent)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+
+def write_snapshot(vocabulary, path=None):
+    """
+    Replaces the committed snapshot (or the one at path), one task name per line so that refreshes are
+    easy to review.
+    """
+    if path is None:
+        path = snapshot_path
+    try:
+        with open(path) as f:
+            version = json.load(f).get("version", 0)
+    except (OSError, ValueError, AttributeError):
+        version = 0
+    write_vocabulary(dict(version=version + 1, **vocabulary), path, indent=1)
+
+
+def read_vocabulary(path):
+    """
+    Returns the vocabulary stored in path, or None if it's missing, unreadable or empty.
+    """
+    try:
+        with open(path) as f:
+            vocabulary = json.load(f)
+        names = vocabulary.get("names")
+        if isinstance(names, list) and len(names) and isinstance(vocabulary.get("retrieved"), str):
+            return vocabulary
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def refresh_in_background():
+    """
+    Refreshes the cache in a detached process, the analyzer doesn't wait for (or depend on) it.
+    """
+    try:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), cache_path],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+    except OSError as e:
+        print(f"Unable to refresh the Cognitive Atlas task cache: {e}")
+
+
+def load_cog_atlas_tasks():
+    """
+    Generates a list of all possible task names from the most recent local copy of the
+    Cognitive Atlas task vocabulary. Doesn't access the network.
+
+    Returns
+    -------
+    tasks : list
+        see normalize_task_names, empty if no copy of the vocabulary is available.
+    """
+    cache = read_vocabulary(cache_path) if cache_path else None
+    if cache_path and refresh_enabled:
+        if cache is None or time.time() - os.path.getmtime(cache_path) > cache_ttl:
+            refresh_in_background()
+
+    vocabularies = [x for x in [read_vocabulary(snapshot_path), cache] if x is not None]
+    if not len(vocabularies):
+        print("No Cognitive Atlas task vocabulary available, task names won't be identified from it")
+        return []
+
+    vocabulary = max(vocabularies, key=lambda x: x["retrieved"])
+    print(f"Using Cognitive Atlas task vocabulary retrieved {vocabulary['retrieved']}")
+
+    return normalize_task_names(vocabulary["names"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Downloads the Cognitive Atlas task vocabulary")
+    parser.add_argument("output", nargs="?", default=cache_path)
+    parser.add_argument("--url", default=cog_atlas_url)
+    parser.add_argument("--snapshot", action="store_true", help=f"refresh the committed {snapshot_path}")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        write_snapshot(fetch_vocabulary(args.url))
+    else:
+        write_vocabulary(fetch_vocabulary(args.url), args.output)
@@ -13,9 +13,10 @@ from __future__ import division
 import os
 import re
 import sys
+import bisect
+import heapq
 import mne
 import json
-import yaml
 import time
 import numpy as np
 import pandas as pd
@@ -24,25 +25,30 @@ from pathlib import Path
 from datetime import date
 from natsort import natsorted
 from operator import itemgetter
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from bids_schema import load_schema, loaded_schema_hash
+from classification_cache import cache_namespace, open_cache as open_classification_cache
+from cog_atlas import load_cog_atlas_tasks, TaskMatcher
 
 DATA_DIR = sys.argv[1]
 
 PROJECT_DIR = Path(__file__).resolve().parents[2]
 BIDS_SCHEMA_DIR = PROJECT_DIR / Path("bids-specification/src/schema")
 
-datatypes_yaml = yaml.load(open(BIDS_SCHEMA_DIR / Path("objects/datatypes.yaml")), Loader=yaml.FullLoader)
-entities_yaml = yaml.load(open(BIDS_SCHEMA_DIR / Path("objects/entities.yaml")), Loader=yaml.FullLoader)
-suffixes_yaml = yaml.load(open(BIDS_SCHEMA_DIR / Path("objects/suffixes.yaml")), Loader=yaml.FullLoader)
-dataset_description_yaml = yaml.load(open(BIDS_SCHEMA_DIR / Path("rules/dataset_metadata.yaml")),
-                                     Loader=yaml.FullLoader)
-datatype_suffix_rules = str(BIDS_SCHEMA_DIR / Path("rules/datatypes"))
-entity_ordering_file = str(BIDS_SCHEMA_DIR / Path("rules/entities.yaml"))
-
-cog_atlas_url = "http://cognitiveatlas.org/api/v-alpha/task"
+# The schema YAML files are parsed once and cached (see bids_schema.py), everyone shares the same copy
+bids_schema = load_schema(BIDS_SCHEMA_DIR)
+datatypes_yaml = bids_schema["datatypes"]
+entities_yaml = bids_schema["entities"]
+suffixes_yaml = bids_schema["suffixes"]
+dataset_description_yaml = bids_schema["dataset_metadata"]
+datatype_suffix_rules = bids_schema["datatype_rules"]
+entity_ordering = bids_schema["entity_ordering"]
 
 accepted_datatypes = ["anat", "dwi", "fmap", "func", "perf", "pet", "meg"]  # Will add others later
 
+# Image metadata (sidecars, NIfTI headers) is read by a pool of threads, sized with EZBIDS_CORE_NJOBS
+ezbids_core_njobs = max(1, int(os.getenv("EZBIDS_CORE_NJOBS", "4")))
+
 MEG_extensions = [".ds", ".fif", ".sqd", ".con", ".raw", ".ave", ".mrk", ".kdf", ".mhd", ".trg", ".chn", ".dat"]
 
 bids_compliant = pd.read_csv(f"{DATA_DIR}/bids_compliant.log", header=None).iloc[1][0]
@@ -54,6 +60,12 @@ else:
 start_time = time.perf_counter()
 analyzer_dir = os.getcwd()
 
+# NIfTI header summaries, by file path (see read_nifti_header)
+nifti_headers = {}
+
+# Sorted directory listings of the upload, by (normalized) directory path (see index_directories)
+directory_index = {}
+
 today_date = date.today().strftime("%Y-%m-%d")
 
 os.chdir(DATA_DIR)
@@ -282,6 +294,74 @@ def _sidecar_json(raw, task, manufacturer, fname, datatype, emptyroom_fname=None
     _write_json(fname, ch_info_json, overwrite)
 
 
+def index_directories(dir):
+    """
+    Lists every directory of the upload a single time (with os.scandir), so that looking for the files that
+    go along with an imaging file, or for ezBIDS configuration files, doesn't list directories over and over.
+    Directories are indexed in (sorted) top-down traversal order. Files created or renamed by the analyzer
+    are recorded with add_directory_entry/remove_directory_entry.
+
+    Parameters
+    ----------
+    dir : string
+        root-level directory of uploaded data
+    """
+    stack = [os.path.normpath(dir)]
+    while stack:
+        root = stack.pop()
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        directory_index[root] = [entry.name for entry in entries]
+        sub_dirs = [
+            os.path.normpath(os.path.join(root, entry.name)) for entry in entries if entry.is_dir(follow_symlinks=False)
+        ]
+        # push in reverse so directories are popped (and listed) in sorted order
+        stack.extend(reversed(sub_dirs))
+
+
+def list_directory(dir):
+    """
+    Returns the sorted file (and directory) names in dir, from the directory index. Directories that
+    weren't indexed (e.g. reached through a symbolic link) are listed on first use.
+    """
+    key = os.path.normpath(dir)
+    if key not in directory_index:
+        directory_index[key] = sorted(os.listdir(key))
+    return directory_index[key]
+
+
+def add_directory_entry(path):
+    """
+    Records a file created by the analyzer in the directory index.
+    """
+    entries = list_directory(os.path.dirname(path))
+    name = os.path.basename(path)
+    position = bisect.bisect_left(entries, name)
+    if position == len(entries) or entries[position] != name:
+        entries.insert(position, name)
+
+
+def remove_directory_entry(path):
+    """
+    Removes a file moved (or deleted) by the analyzer from the directory index.
+    """
+    entries = list_directory(os.path.dirname(path))
+    name = os.path.basename(path)
+    position = bisect.bisect_left(entries, name)
+    if position < len(entries) and entries[position] == name:
+        entries.pop(position)
+
+
+def directory_entry_exists(path):
+    """
+    Same as os.path.exists, from the directory index.
+    """
+    entries = list_directory(os.path.dirname(path))
+    name = os.path.basename(path)
+    position = bisect.bisect_left(entries, name)
+    return position < len(entries) and entries[position] == name
+
+
 def fix_multiple_dots(uploaded_img_list):
     '''
     Occasionally, data files with have multiple periods ('.') in their file names.
@@ -324,7 +404,7 @@ def fix_multiple_dots(uploaded_img_list):
             img_dir = os.path.dirname(img_path)
 
             corresponding_files = [
-                img_dir + '/' + x for x in os.listdir(img_dir)
+                img_dir + '/' + x for x in list_directory(img_dir)
                 if os.path.basename(img_path).split(ext)[0] in x
             ]
 
@@ -347,6 +427,8 @@ def fix_multiple_dots(uploaded_img_list):
                 new_file_name = f".{'_'.join(typo_split_list[1:])}{ext}"
 
                 os.system(f'mv {typo} {new_file_name}')
+                remove_directory_entry(typo)
+                add_directory_entry(new_file_name)
 
                 if typo in uploaded_img_list:
                     idx = uploaded_img_list.index(typo)
@@ -435,6 +517,74 @@ def generate_MEG_json_sidecars(uploaded_img_list):
             _update_sidecar(json_output_name, "Modality", "MEG")
             _update_sidecar(json_output_name, "ConversionSoftware", "MNE-BIDS")
             _update_sidecar(json_output_name, "SeriesDescription", fname)
+            add_directory_entry(meg.split(ext)[0] + ".json")
+
+
+class NiftiHeader:
+    """
+    Summary of a NIfTI header, holding only what ezBIDS needs so that image objects (and their
+    file handles and data proxies) don't stay alive for the whole run.
+
+    Attributes
+    ----------
+    affine : numpy array
+    shape : tuple
+    ndim : int
+    zooms : tuple
+    dtype : numpy dtype
+        data type of the image data array
+    header_class : class
+        nibabel header class (e.g. Nifti1Header) of the image
+    binaryblock : bytes
+        raw header, the header text is only rendered (see header_text) when it's needed
+    """
+    __slots__ = ("affine", "shape", "ndim", "zooms", "dtype", "header_class", "binaryblock")
+
+    def __init__(self, image):
+        self.affine = image.affine
+        self.shape = image.shape
+        self.ndim = image.ndim
+        self.zooms = image.header.get_zooms()
+        self.dtype = image.get_data_dtype()
+        self.header_class = type(image.header)
+        self.binaryblock = image.header.binaryblock
+
+    def header_text(self):
+        """
+        Header text, one line per field (i.e. str(image.header) without its first line).
+        """
+        return str(self.header_class(self.binaryblock, check=False)).splitlines()[1:]
+
+
+def read_nifti_header(img_file):
+    """
+    Reads the header of a NIfTI file, once: the summary is kept in nifti_headers and shared by
+    modify_uploaded_dataset_list, generate_dataset_list and modify_objects_info.
+
+    Parameters
+    ----------
+    img_file : string
+        path to the NIfTI file
+
+    Returns
+    -------
+    nifti_header : NiftiHeader
+        Raises an exception if img_file can't be read by nibabel.
+    """
+    if img_file not in nifti_headers:
+        nifti_headers[img_file] = NiftiHeader(nib.load(img_file))
+    return nifti_headers[img_file]
+
+
+def try_read_nifti_header(img_file):
+    """
+    Same as read_nifti_header, but returns None rather than raising if img_file can't be read.
+    Used to read headers ahead of time in worker threads.
+    """
+    try:
+        return read_nifti_header(img_file)
+    except:
+        return None
 
 
 def modify_uploaded_dataset_list(uploaded_img_list):
@@ -474,16 +624,23 @@ def modify_uploaded_dataset_list(uploaded_img_list):
     exclude_data = False
 
     config_file_list = []
-    for root, dirs, files in os.walk(DATA_DIR):
-        for file in files:
-            if file.endswith('ezBIDS_template.json'):
-                config_file_list.append(os.path.join(root, file))
+    for dir, entries in directory_index.items():
+        for entry in entries:
+            if entry.endswith('ezBIDS_template.json'):
+                config_file_list.append(os.path.join(DATA_DIR, os.path.normpath(os.path.join(dir, entry))))
 
     if len(config_file_list):
         # Ideally only one config file uploaded, but if multiple configurations found, select last one (most recent?)
         config = True
         config_file = config_file_list[-1]
 
+    # Read the NIfTI headers in parallel, the checks below then use the cached headers
+    with ThreadPoolExecutor(max_workers=ezbids_core_njobs) as executor:
+        list(executor.map(
+            try_read_nifti_header,
+            [x for x in uploaded_img_list if not x.endswith(tuple(MEG_extensions)) and not x.endswith('blood.json')]
+        ))
+
     # Parse img files
     for img_file in uploaded_img_list:
         if img_file.endswith('.nii.gz'):
@@ -497,7 +654,7 @@ def modify_uploaded_dataset_list(uploaded_img_list):
 
         if not img_file.endswith(tuple(MEG_extensions)) and not img_file.endswith('blood.json'):
             try:
-                nib.load(img_file)
+                read_nifti_header(img_file)
             except:
                 exclude_data = True
                 print(f'{img_file} is not a properly formatted imaging file. Will not be converted by ezBIDS.')
@@ -505,7 +662,7 @@ def modify_uploaded_dataset_list(uploaded_img_list):
 
         img_dir = os.path.dirname(img_file)
         grouped_files = [
-            img_dir + '/' + x for x in os.listdir(img_dir)
+            img_dir + '/' + x for x in list_directory(img_dir)
             if os.path.basename(img_file).split(ext)[0] + "." in x
         ]
 
@@ -737,34 +894,6 @@ def generate_participants_columns(DATA_DIR, bids_compliant):
     return participants_column_info
 
 
-def find_cog_atlas_tasks(url):
-    """
-    Generates a list of all possible task names from the Cognitive Atlas API
-    task webpage.
-
-    Parameters
-    ----------
-    url : string
-        web url of the Cognitive Atlas API task page.
-
-    Returns
-    -------
-    tasks : list
-        list of all possible task names. Each task name has spaces, "task", and
-        "test" removed, to make it easier to search the SeriesDescription
-        fields for a matching task name.
-    """
-    url_contents = urlopen(url)
-    data = json.load(url_contents)
-    # Remove non-alphanumeric terms and "task", "test" substrings
-    tasks = [re.sub("[^A-Za-z0-9]+", "", re.split(" task| test", x["name"])[0]).lower() for x in data]
-    # Remove empty task name terms and ones under 2 characters (b/c hard to detect in SeriesDescription)
-    tasks = [x for x in tasks if len(x) > 2]
-    tasks = sorted(tasks, key=str.casefold)  # sort alphabetically, but ignore case
-
-    return tasks
-
-
 def correct_pe(pe_direction, ornt, correction):
     """
     Equivalent to fMRIPrep's get_world_pedir (Esteban et al., 2019) function.
@@ -887,6 +1016,92 @@ def determine_direction(proper_pe_direction, ornt):
     return direction
 
 
+def index_corresponding_files(corresponding_files_list):
+    """
+    Indexes the files (JSON, bval/bvec, tsv, etc) that may belong to an imaging file, so that the
+    ones belonging to a given imaging file can be found without scanning the whole list.
+
+    Parameters
+    ----------
+    corresponding_files_list : list
+        File paths, in the order in which matches should be returned.
+
+    Returns
+    -------
+    corresponding_files_index : list
+        (path, position in corresponding_files_list) tuples, sorted by path.
+    """
+    return sorted((x, position) for position, x in enumerate(corresponding_files_list))
+
+
+def add_corresponding_file(corresponding_files_index, path):
+    """
+    Adds a file to the index, after all the files already in it.
+    """
+    bisect.insort(corresponding_files_index, (path, len(corresponding_files_index)))
+
+
+def find_corresponding_files(corresponding_files_index, prefix):
+    """
+    Returns the indexed files whose path starts with prefix, in their original order. Uploaded file paths
+    all start from the upload root ("./"), so this is the same as looking for prefix anywhere in the paths.
+    """
+    matches = []
+    for path, position in corresponding_files_index[bisect.bisect_left(corresponding_files_index, (prefix,)):]:
+        if not path.startswith(prefix):
+            break
+        matches.append((position, path))
+    return [path for position, path in sorted(matches)]
+
+
+def find_sidecar(img_file, ext, corresponding_files_index):
+    """
+    Returns the path of the JSON sidecar of an imaging file, or None if it doesn't have one.
+    """
+    if img_file.endswith('.blood.json'):
+        corresponding_json = img_file
+    else:
+        corresponding_json = [
+            x for x in find_corresponding_files(corresponding_files_index, img_file.split(ext)[0])
+            if x.endswith('.json')
+        ]  # should be length of 1, but may be empty (i.e. no metadata json file)
+
+    if len(corresponding_json):
+        return corresponding_json[0]
+    return None
+
+
+def read_image_metadata(img_file, json_path):
+    """
+    Reads what generate_dataset_list needs from disk for an imaging file: its JSON sidecar, NIfTI header
+    (cached by read_nifti_header) and file size. Safe to call from worker threads.
+
+    Parameters
+    ----------
+    img_file : string
+        path to the imaging file
+
+    json_path : string or None
+        path to the JSON sidecar, as returned by find_sidecar
+
+    Returns
+    -------
+    json_data : dictionary or None
+        contents of the JSON sidecar, None if json_path is None
+
+    filesize : int
+        size of img_file, in bytes
+    """
+    json_data = None
+    if json_path is not None:
+        with open(json_path) as f:
+            json_data = json.load(f, strict=False)
+
+    try_read_nifti_header(img_file)  # not a NIfTI file (or unreadable) if None, generate_dataset_list handles it
+
+    return json_data, os.stat(img_file).st_size
+
+
 def generate_dataset_list(uploaded_files_list, exclude_data):
     """
     Takes list of NIfTI, JSON, (and bval/bvec) files generated from dcm2niix
@@ -931,6 +1146,7 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
         or x.endswith(tuple(MEG_extensions))
         or x.endswith('blood.tsv')  # do we need this last one?
     ])
+    corresponding_files_index = index_corresponding_files(corresponding_files_list)
 
     print('')
     print("Determining unique acquisitions in dataset")
@@ -938,8 +1154,9 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
     sub_info_list_id = "01"
     sub_info_list = []
 
+    # Find file extensions
+    ext_list = []
     for img_file in img_list:
-        # Find file extension
         if img_file.endswith('.nii.gz'):
             ext = '.nii.gz'
         elif img_file.endswith('.v.gz'):
@@ -948,18 +1165,28 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
             ext = '.ds'
         else:
             ext = Path(img_file).suffix
+        ext_list.append(ext)
 
-        if img_file.endswith('.blood.json'):
-            corresponding_json = img_file
-        else:
-            corresponding_json = [
-                x for x in corresponding_files_list if x.endswith('.json') and img_file.split(ext)[0] in x
-            ]  # should be length of 1, but may be empty (i.e. no metadata json file)
-
-        if len(corresponding_json):
-            json_path = corresponding_json[0]
-            json_data = open(corresponding_json[0])
-            json_data = json.load(json_data, strict=False)
+    """
+    Reading the JSON sidecars, NIfTI headers and file sizes is done in parallel. Everything else depends on
+    the order of the images (subject counter, sidecars written along the way) and stays sequential, sidecars
+    that were (re)written after being read are read again.
+    """
+    sidecar_paths = [find_sidecar(x, y, corresponding_files_index) for x, y in zip(img_list, ext_list)]
+    with ThreadPoolExecutor(max_workers=ezbids_core_njobs) as executor:
+        image_metadata = list(executor.map(read_image_metadata, img_list, sidecar_paths))
+    rewritten_sidecars = set()
+
+    for img_file, ext, sidecar_path, (sidecar_data, filesize) in zip(img_list, ext_list, sidecar_paths,
+                                                                      image_metadata):
+        json_path = find_sidecar(img_file, ext, corresponding_files_index)
+
+        if json_path is not None:
+            if json_path == sidecar_path and json_path not in rewritten_sidecars:
+                json_data = sidecar_data
+            else:
+                json_data = open(json_path)
+                json_data = json.load(json_data, strict=False)
         else:
             json_path = img_file.split(ext)[0] + '.json'
             json_data = {
@@ -981,7 +1208,7 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
             pe_direction = None
 
         try:
-            ornt = nib.aff2axcodes(nib.load(img_file).affine)
+            ornt = nib.aff2axcodes(read_nifti_header(img_file).affine)
             ornt = "".join(ornt)
         except:
             ornt = None
@@ -993,13 +1220,11 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
                 json_data['PhaseEncodingDirection'] = proper_pe_direction
                 with open(json_path, "w") as fp:
                     json.dump(json_data, fp, indent=3)
+                rewritten_sidecars.add(json_path)
             ped = determine_direction(proper_pe_direction, ornt)
         else:
             ped = ""
 
-        # Find image file size
-        filesize = os.stat(img_file).st_size
-
         # Find StudyID from json
         if "StudyID" in json_data:
             study_id = json_data["StudyID"]
@@ -1109,32 +1334,32 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
 
         # Get the nibabel nifti image info
         if img_file.endswith('.nii.gz') or img_file.endswith('.nii'):
-            image = nib.load(img_file)
-            ndim = image.ndim
+            nifti_header = read_nifti_header(img_file)
+            ndim = nifti_header.ndim
 
             # If RepetitionTime (TR) not in JSON metadata, add to file
             if repetition_time == 0:
-                if len(image.header.get_zooms()) == 4:
-                    repetition_time = image.header.get_zooms()[-1]
+                if len(nifti_header.zooms) == 4:
+                    repetition_time = nifti_header.zooms[-1]
                     if not isinstance(repetition_time, int):
                         repetition_time = round(float(repetition_time), 2)
                     json_data['RepetitionTime'] = repetition_time
 
             # Find how many volumes are in nifti file
             try:
-                volume_count = image.shape[3]
+                volume_count = nifti_header.shape[3]
             except:
                 volume_count = 1
         elif img_file.endswith(tuple(MEG_extensions)):
-            image = "n/a"
+            nifti_header = "n/a"
             volume_count = 1
             ndim = 4
         elif img_file.endswith("blood.json"):
-            image = "n/a"
+            nifti_header = "n/a"
             volume_count = 1
             ndim = 2
         else:  # add as we support new imaging modalities
-            image = 'n/a'
+            nifti_header = "n/a"
             volume_count = 1
             ndim = 2
 
@@ -1232,16 +1457,19 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
         session = re.sub("[^A-Za-z0-9]+", "", session)
 
         # If uploaded data didn't contain JSON metadata, add here
-        if not os.path.exists(json_path):
+        if not directory_entry_exists(json_path):
             with open(json_path, "w") as fp:
                 json.dump(json_data, fp, indent=3)
-            corresponding_files_list = corresponding_files_list + [json_path]
+            add_corresponding_file(corresponding_files_index, json_path)
+            add_directory_entry(json_path)
+            rewritten_sidecars.add(json_path)
             json_data = open(json_path)
             json_data = json.load(json_data, strict=False)
 
         # Files (JSON, bval/bvec, tsv) associated with imaging file
         corresponding_file_paths = [
-            x for x in corresponding_files_list if f"{img_file.split(ext)[0]}." in x and not x.endswith(ext)
+            x for x in find_corresponding_files(corresponding_files_index, f"{img_file.split(ext)[0]}.")
+            if not x.endswith(ext)
         ]
 
         # Relative paths of NIfTI and JSON files (per SeriesNumber)
@@ -1292,7 +1520,7 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
             "message": None,
             "type": data_type,
             "nifti_path": img_file,
-            "nibabel_image": image,
+            "nifti_header": nifti_header,
             "ndim": ndim,
             "json_path": json_path,
             "file_directory": "/".join([x for x in img_file.split("/") if not x.endswith(ext)]),
@@ -1315,6 +1543,23 @@ def generate_dataset_list(uploaded_files_list, exclude_data):
     return dataset_list
 
 
+def group_acquisitions(dataset_list, columns):
+    """
+    Groups the acquisitions that share the same values for columns, in a single pass over dataset_list.
+
+    Returns
+    -------
+    groups : dictionary
+        (value of each column) -> acquisitions with those values, in dataset_list order. Keys are
+        single values, rather than tuples, when only one column is given.
+    """
+    groups = {}
+    for x in dataset_list:
+        key = tuple(x[col] for col in columns) if len(columns) > 1 else x[columns[0]]
+        groups.setdefault(key, []).append(x)
+    return groups
+
+
 def organize_dataset(dataset_list):
     """
     Organize data files into pseudo subject (and session, if applicable) groups.
@@ -1338,13 +1583,34 @@ def organize_dataset(dataset_list):
         List of dictionaries containing pertinent and unique information about
         the data, primarily coming from the metadata in the json files.
     """
-    dataset_list = sorted(dataset_list, key=itemgetter(
-        "subject",
-        "AcquisitionTime",
-        "ModifiedSeriesNumber")
-    )
+    sort_key = itemgetter("subject", "AcquisitionTime", "ModifiedSeriesNumber")
+    dataset_list = sorted(dataset_list, key=sort_key)
+
+    """
+    Each anonymized acquisition is compared with the acquisition at the position preceding its own in the list
+    as it stands once the previous acquisitions got their pseudo subject IDs, i.e. sorted again (stable sort)
+    after every renamed acquisition. Rather than sorting the whole list that many times, the order is given by
+    (sort key, tie break) entries, and the acquisitions at the first index positions of it are tracked: they are
+    taken one at a time from a heap of the other entries, so the last one taken is the preceding acquisition.
+    A renamed acquisition only moves further down the list.
+    """
+    entries = [(sort_key(x), index, index) for index, x in enumerate(dataset_list)]
+    others = list(entries)  # sorted, so already a heap
+    leading = [False] * len(dataset_list)
+    first_tie_break = {}
+    for key, tie_break, _ in entries:
+        first_tie_break.setdefault(key, tie_break)
+
+    def take_first():
+        # entries of renamed (outdated entries) or already taken acquisitions are skipped
+        while True:
+            entry = heapq.heappop(others)
+            if entry is entries[entry[2]] and not leading[entry[2]]:
+                leading[entry[2]] = True
+                return entry[2]
 
     pseudo_sub = 1
+    preceding = None
     for index, unique_dic in enumerate(dataset_list):
         if unique_dic["subject"] == "n/a":
             if (unique_dic["AcquisitionDateTime"] == "0000-00-00T00:00:00.000000"
@@ -1354,7 +1620,7 @@ def organize_dataset(dataset_list):
                 if index == 0:
                     subj = pseudo_sub
                 else:
-                    previous_data = dataset_list[index - 1]
+                    previous_data = dataset_list[preceding]
                     if unique_dic["SeriesNumber"] >= previous_data["SeriesNumber"]:
                         if not unique_dic["SeriesNumber"] - previous_data["SeriesNumber"] < 2:
                             # Probably a misalignment, adjust pseudo subject ID
@@ -1370,13 +1636,20 @@ def organize_dataset(dataset_list):
                 unique_dic["subject"] = (unique_dic["subject"] + ("0" * (4 - len(str(subj)))) + str(subj))
                 unique_dic["AcquisitionDateTime"] = unique_dic["subject"][:-4]
 
-        dataset_list = sorted(dataset_list, key=itemgetter(
-            "subject",
-            "AcquisitionTime",
-            "ModifiedSeriesNumber")
-        )
+                # The subject ID only gained a suffix, so the sort key grew: the stable sort keeps the acquisition
+                # ahead of the acquisitions it now ties with
+                key = sort_key(unique_dic)
+                tie_break = first_tie_break.get(key, index + 1) - 1
+                first_tie_break[key] = tie_break
+                entries[index] = (key, tie_break, index)
+                heapq.heappush(others, entries[index])
+                if leading[index]:
+                    leading[index] = False
+                    preceding = take_first()
 
-    return dataset_list
+        preceding = take_first()
+
+    return [dataset_list[x[2]] for x in sorted(entries)]
 
 
 def determine_sub_ses_IDs(dataset_list, bids_compliant):
@@ -1411,68 +1684,70 @@ def determine_sub_ses_IDs(dataset_list, bids_compliant):
     subject_idx_counter = 0
     subs_information = []
     participants_info = {}
+
+    # Organize phenotype (e.g., species, sex, age, handedness) information. For BIDS-compliant uploads this
+    # comes from participants.tsv, which is the same for every subject and only needs to be parsed once
+    bids_root_dir = pd.read_csv(f"{DATA_DIR}/bids_compliant.log", header=None).iloc[0][0]
+    participants_tsv = bids_compliant is True and os.path.isfile(f"{bids_root_dir}/participants.tsv")
+    if participants_tsv:
+        participants_info_data = pd.read_csv(f"{bids_root_dir}/participants.tsv", sep="\t")
+
+        participants_info_columns = ([x for x in participants_info_data.columns if x != "participant_id"]
+                                     + ["PatientID", "PatientName"])
+
+        for len_index in range(len(participants_info_data)):
+            participants_info[str(len_index)] = dict.fromkeys(participants_info_columns)
+
+            for col in participants_info_columns:
+                if col not in ["PatientID", "PatientName"]:
+                    participants_info[str(len_index)][col] = str(participants_info_data[col].iloc[len_index])
+                else:
+                    if "sub-" in participants_info_data["participant_id"].iloc[len_index]:
+                        participant_id = participants_info_data["participant_id"].iloc[len_index].split("-")[-1]
+                    else:
+                        participant_id = participants_info_data["participant_id"].iloc[len_index]
+
+                    participants_info[str(len_index)]["PatientID"] = str(participant_id)
+                    participants_info[str(len_index)]["PatientName"] = str(participant_id)
+
     # Determine unique subjects from uploaded dataset
+    subject_groups = group_acquisitions(dataset_list, ["subject"])
     for sub in np.unique([x["subject"] for x in dataset_list]):
-        sub_dics_list = [x for x in dataset_list if x["subject"] == sub]
+        sub_dics_list = subject_groups[sub]
 
         # Give each subject a unique subject_idx value
         for x in sub_dics_list:
             x["subject_idx"] = subject_idx_counter
         subject_idx_counter += 1
 
-        # Organize phenotype (e.g., species, sex, age, handedness) information
-        bids_root_dir = pd.read_csv(f"{DATA_DIR}/bids_compliant.log", header=None).iloc[0][0]
-        if bids_compliant is True and os.path.isfile(f"{bids_root_dir}/participants.tsv"):
-            participants_info_data = pd.read_csv(f"{bids_root_dir}/participants.tsv", sep="\t")
-
-            participants_info = {}
-            participants_info_columns = ([x for x in participants_info_data.columns if x != "participant_id"]
-                                         + ["PatientID", "PatientName"])
+        if not participants_tsv:
+            phenotype_info = {
+                "species": sub_dics_list[0]["PatientSpecies"],
+                "sex": sub_dics_list[0]["PatientSex"],
+                "age": sub_dics_list[0]["PatientAge"],
+                "handedness": sub_dics_list[0]["PatientHandedness"],
+                "PatientName": sub_dics_list[0]["PatientID"],
+                "PatientID": sub_dics_list[0]["PatientName"],
+                "FileDirectory": sub_dics_list[0]["file_directory"]
+            }
 
-            for len_index in range(len(participants_info_data)):
-                participants_info[str(len_index)] = dict.fromkeys(participants_info_columns)
+            participants_info.update({str(sub_dics_list[0]["subject_idx"]): phenotype_info})
 
-                for col in participants_info_columns:
-                    if col not in ["PatientID", "PatientName"]:
-                        participants_info[str(len_index)][col] = str(participants_info_data[col].iloc[len_index])
-                    else:
-                        if "sub-" in participants_info_data["participant_id"].iloc[len_index]:
-                            participant_id = participants_info_data["participant_id"].iloc[len_index].split("-")[-1]
-                        else:
-                            participant_id = participants_info_data["participant_id"].iloc[len_index]
+        # Determine all unique sessions (if applicable) per subject, i.e. (session, AcquisitionDate) pairs
+        ses_groups = {}
+        for x in sub_dics_list:
+            ses_groups.setdefault((x["session"], x["AcquisitionDate"]), []).append(x)
 
-                        participants_info[str(len_index)]["PatientID"] = str(participant_id)
-                        participants_info[str(len_index)]["PatientName"] = str(participant_id)
-        else:
-            phenotype_info = list(
-                {
-                    "species": x["PatientSpecies"],
-                    "sex": x["PatientSex"],
-                    "age": x["PatientAge"],
-                    "handedness": x["PatientHandedness"],
-                    "PatientName": x["PatientID"],
-                    "PatientID": x["PatientName"],
-                    "FileDirectory": x["file_directory"]
-                } for x in sub_dics_list)[0]
-
-            participants_info.update({str(x["subject_idx"]): phenotype_info})
-
-        # Determine all unique sessions (if applicable) per subject
+        # Session information includes the following metadata: session, AcquisitionDate, and AcquisitionTime,
+        # taken (along with the patient information) from the first acquisition of the session
         unique_ses_date_times = []
         session_idx_counter = 0
         ses_dates = list(set([(x["session"], x["AcquisitionDate"]) for x in sub_dics_list]))
-
-        # Session information includes the following metadata: session, AcquisitionDate, and AcquisitionTime
-        for ses_date in ses_dates:
-            ses_date = list(ses_date)
-            date_time = [
-                x["AcquisitionTime"] for x in sub_dics_list if x["session"] == ses_date[0]
-                and x["AcquisitionDate"] == ses_date[1]][0]
-            ses_date.append(date_time)
+        for ses, acq_date in ses_dates:
             dic = {
-                "session": ses_date[0],
-                "AcquisitionDate": ses_date[1],
-                "AcquisitionTime": ses_date[2],
+                "session": ses,
+                "AcquisitionDate": acq_date,
+                "AcquisitionTime": ses_groups[(ses, acq_date)][0]["AcquisitionTime"],
                 "exclude": False,
                 "session_idx": 0
             }
@@ -1494,19 +1769,12 @@ def determine_sub_ses_IDs(dataset_list, bids_compliant):
         # Pair patient information (PatientID, PatientName, PatientBirthDate) with corresponding session information
         patient_info = []
         for ses_info in unique_ses_date_times:
+            first_dic = ses_groups[(ses_info["session"], ses_info["AcquisitionDate"])][0]
             patient_dic = {
-                "PatientID": [
-                    x["PatientID"] for x in sub_dics_list if x["session"] == ses_info["session"]
-                    and x["AcquisitionDate"] == ses_info["AcquisitionDate"]][0],
-                "PatientName": [
-                    x["PatientName"] for x in sub_dics_list if x["session"] == ses_info["session"]
-                    and x["AcquisitionDate"] == ses_info["AcquisitionDate"]][0],
-                "PatientBirthDate": [
-                    x["PatientBirthDate"] for x in sub_dics_list if x["session"] == ses_info["session"]
-                    and x["AcquisitionDate"] == ses_info["AcquisitionDate"]][0],
-                "file_directory": [
-                    x["file_directory"] for x in sub_dics_list if x["session"] == ses_info["session"]
-                    and x["AcquisitionDate"] == ses_info["AcquisitionDate"]][0]
+                "PatientID": first_dic["PatientID"],
+                "PatientName": first_dic["PatientName"],
+                "PatientBirthDate": first_dic["PatientBirthDate"],
+                "file_directory": first_dic["file_directory"]
             }
             patient_info.append(patient_dic)
 
@@ -1518,22 +1786,21 @@ def determine_sub_ses_IDs(dataset_list, bids_compliant):
         AcquisitionDate cannot be used with anonymized data because that metadata
         is removed.
         """
-        unique_ses_dates = [[x["session"], x["AcquisitionDate"]] for x in unique_ses_date_times]
-        for ses_date in unique_ses_dates:
-            unique_dates_dics_list = [x for x in unique_ses_date_times if x["AcquisitionDate"] == ses_date[1]]
+        date_groups = {}
+        for dic in unique_ses_date_times:
+            date_groups.setdefault(dic["AcquisitionDate"], []).append(dic)
+        for unique_dates_dics_list in date_groups.values():
             if len(unique_dates_dics_list) > 1:
                 for date_dic in unique_dates_dics_list:
-                    date_dic["AcquisitionDate"] = ses_date[1] + "." + str(date_counter)
+                    date_dic["AcquisitionDate"] = date_dic["AcquisitionDate"] + "." + str(date_counter)
                     date_counter += 1
 
         # update dataset_list with updated AcquisitionDate and session_idx info
         for sub_ses_map_dic in unique_ses_date_times:
-            for data_dic in dataset_list:
-                if (data_dic["subject"] == sub
-                        and data_dic["session"] == sub_ses_map_dic["session"]
-                        and data_dic["AcquisitionDate"] == sub_ses_map_dic["AcquisitionDate"].split(".")[0]):
-                    data_dic["AcquisitionDate"] = sub_ses_map_dic["AcquisitionDate"]
-                    data_dic["session_idx"] = sub_ses_map_dic["session_idx"]
+            original_date = sub_ses_map_dic["AcquisitionDate"].split(".")[0]
+            for data_dic in ses_groups.get((sub_ses_map_dic["session"], original_date), []):
+                data_dic["AcquisitionDate"] = sub_ses_map_dic["AcquisitionDate"]
+                data_dic["session_idx"] = sub_ses_map_dic["session_idx"]
 
         """
         Using all the information gathered above, build the subject/session
@@ -1542,13 +1809,12 @@ def determine_sub_ses_IDs(dataset_list, bids_compliant):
         subject_ids_info = {
             "subject": sub,
             "PatientInfo": patient_info,
-            "phenotype": list(
-                {
-                    "species": x["PatientSpecies"],
-                    "sex": x["PatientSex"],
-                    "age": x["PatientAge"],
-                    "handedness": x["PatientHandedness"]
-                } for x in sub_dics_list)[0],
+            "phenotype": {
+                "species": sub_dics_list[0]["PatientSpecies"],
+                "sex": sub_dics_list[0]["PatientSex"],
+                "age": sub_dics_list[0]["PatientAge"],
+                "handedness": sub_dics_list[0]["PatientHandedness"]
+            },
             "exclude": False,
             "sessions": [
                 {k: v for k, v in d.items()
@@ -1583,7 +1849,7 @@ def determine_unique_series(dataset_list, bids_compliant):
         dictionaries of acquisitions with a unique series group ID.
     """
     dataset_list_unique_series = []
-    series_checker = []
+    series_checker = {}  # heuristic items -> series_idx of the first acquisition with those items
     series_idx = 0
 
     for index, acquisition_dic in enumerate(dataset_list):
@@ -1622,25 +1888,19 @@ def determine_unique_series(dataset_list, bids_compliant):
             acquisition_dic["series_idx"] = series_idx
             dataset_list_unique_series.append(acquisition_dic)
         else:
+            # ImageType is a list, make the items hashable
+            series_key = tuple(tuple(x) if isinstance(x, list) else x for x in heuristic_items)
             if index == 0:
                 acquisition_dic["series_idx"] = 0
                 dataset_list_unique_series.append(acquisition_dic)
+            elif series_key not in series_checker:
+                series_idx += 1
+                acquisition_dic["series_idx"] = series_idx
+                dataset_list_unique_series.append(acquisition_dic)
             else:
-                if heuristic_items[1:3] not in [x[1:3] for x in series_checker]:
-                    series_idx += 1
-                    acquisition_dic["series_idx"] = series_idx
-                    dataset_list_unique_series.append(acquisition_dic)
-                else:
-                    if heuristic_items not in [x[:-1] for x in series_checker]:
-                        series_idx += 1
-                        acquisition_dic["series_idx"] = series_idx
-                        dataset_list_unique_series.append(acquisition_dic)
-                    else:
-                        common_series_index = [x[:-1] for x in series_checker].index(heuristic_items)
-                        common_series_idx = series_checker[common_series_index][-1]
-                        acquisition_dic["series_idx"] = common_series_idx
+                acquisition_dic["series_idx"] = series_checker[series_key]
 
-            series_checker.append(heuristic_items + [acquisition_dic["series_idx"]])
+            series_checker.setdefault(series_key, acquisition_dic["series_idx"])
 
     return dataset_list, dataset_list_unique_series
 
@@ -1833,6 +2093,28 @@ def template_configuration(dataset_list_unique_series, subs_information, config_
             dataset_list_unique_series, subs_information, events, bids_uri)
 
 
+def compile_conditions(conditions):
+    """
+    Compiles lookup_dic conditions (python expressions, kept as text for the UI messages) into functions,
+    so they are parsed once rather than every time a series is checked against them.
+
+    Parameters
+    ----------
+    conditions : list
+        conditions of a datatype/suffix pair in lookup_dic, which may refer to sd, unique_dic,
+        dataset_list_unique_series and index.
+
+    Returns
+    -------
+    predicates : list
+        one function per condition, called with (sd, unique_dic, dataset_list_unique_series, index).
+    """
+    return [
+        eval(compile(f"lambda sd, unique_dic, dataset_list_unique_series, index: ({x})", "<lookup condition>", "eval"))
+        for x in conditions
+    ]
+
+
 def create_lookup_info():
     """
     Creates a lookup dictionary of conditionals for identifying different
@@ -1863,8 +2145,7 @@ def create_lookup_info():
     for datatype in datatypes_yaml.keys():
         if datatype in accepted_datatypes:
             lookup_dic[datatype] = {}
-            rule = yaml.load(open(os.path.join(analyzer_dir, datatype_suffix_rules, datatype) + ".yaml"),
-                             Loader=yaml.FullLoader)
+            rule = datatype_suffix_rules[datatype]
 
             for key in rule.keys():
                 suffixes = rule[key]["suffixes"]
@@ -2250,9 +2531,268 @@ def create_lookup_info():
         }
     }
 
+    for datatype in lookup_dic:
+        for suffix in lookup_dic[datatype]:
+            lookup_dic[datatype][suffix]["predicates"] = compile_conditions(lookup_dic[datatype][suffix]["conditions"])
+
     return lookup_dic
 
 
+def create_suffix_index():
+    """
+    Indexes the suffixes of each datatype in the BIDS schema, so that datatype_suffix_identification
+    can match file paths against them with dictionary lookups rather than by walking the datatype rules
+    for every acquisition.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    suffix_index : dictionary
+        "suffixes": datatype -> {suffix: position}, the (non-deprecated) suffixes of each datatype.
+        "bad_suffixes": datatype -> {suffix: position}, short and unhelpful suffixes of each datatype.
+        "bad_suffix_datatypes": bad suffix -> the datatype it implies.
+        "suffix_case": lowercase suffix -> suffix, as spelled in the BIDS schema.
+        Positions preserve the order in which the suffixes appear in the datatype rules.
+    """
+    suffix_index = {
+        "suffixes": {},
+        "bad_suffixes": {},
+        "bad_suffix_datatypes": {
+            "fieldmap": "fmap",
+            "beh": "beh",
+            "epi": "fmap",
+            "magnitude": "fmap",
+            "magnitude1": "fmap",
+            "magnitude2": "fmap",
+            "phasediff": "fmap",
+            "PC": "micr",
+            "DF": "micr"
+        },
+        "suffix_case": {x.lower(): x for x in suffixes_yaml}
+    }
+
+    unhelpful_suffixes = [
+        "fieldmap",
+        "beh",
+        "epi",
+        "magnitude",
+        "magnitude1",
+        "magnitude2",
+        "phasediff"
+    ]
+
+    # Remove deprecated suffixes
+    deprecated_suffixes = ["T2star", "FLASH", "PD", "phase"]
+
+    for datatype in datatypes_yaml:
+        rule = datatype_suffix_rules[datatype]
+
+        suffixes = [x for y in [rule[x]["suffixes"] for x in rule] for x in y]
+
+        short_suffixes = [x for x in suffixes if len(x) < 3]
+
+        bad_suffixes = short_suffixes + unhelpful_suffixes
+
+        suffixes = [x for x in suffixes if x not in deprecated_suffixes]
+
+        # where a suffix is listed several times, its last position is the one that takes effect
+        suffix_index["suffixes"][datatype] = {suffix: i for i, suffix in enumerate(suffixes)}
+        suffix_index["bad_suffixes"][datatype] = {suffix: i for i, suffix in enumerate(bad_suffixes)}
+
+    return suffix_index
+
+
+def create_search_term_index(lookup_dic):
+    """
+    Inverted index of the lookup_dic search terms, so that the search terms found in a SeriesDescription
+    (or ProtocolName) are determined in a single scan of it, whatever the number of datatype/suffix pairs.
+
+    Parameters
+    ----------
+    lookup_dic : dictionary
+        see create_lookup_info
+
+    Returns
+    -------
+    search_term_index : dictionary
+        "pattern": regex matching, at every position of the normalized SeriesDescription, the longest
+        search term that starts there.
+        "prefixes": search term -> the search terms it starts with (itself included), i.e. the other
+        search terms present wherever it is.
+        "rules": search term -> (priority, datatype, suffix) of the lookup_dic pairs that list it.
+        "localizer", "dwi": (priority, datatype, suffix) of the pairs that are checked even when none
+        of their search terms are found.
+        Priorities are the order in which the pairs are listed in lookup_dic.
+    """
+    search_term_index = {
+        "pattern": None,
+        "prefixes": {},
+        "rules": {},
+        "localizer": None,
+        "dwi": None
+    }
+
+    priority = 0
+    for datatype in lookup_dic:
+        for suffix in lookup_dic[datatype]:
+            rule = (priority, datatype, suffix)
+            for term in lookup_dic[datatype][suffix]["search_terms"]:
+                search_term_index["rules"].setdefault(term, []).append(rule)
+            if datatype == "localizer":
+                search_term_index["localizer"] = rule
+            elif datatype == "dwi" and suffix == "dwi":
+                search_term_index["dwi"] = rule
+            priority += 1
+
+    terms = sorted(search_term_index["rules"], key=len, reverse=True)
+    for term in terms:
+        search_term_index["prefixes"][term] = [x for x in terms if term.startswith(x)]
+
+    if len(terms):
+        # longest terms first, so each match is the longest search term at that position
+        search_term_index["pattern"] = re.compile("(?=(" + "|".join(re.escape(x) for x in terms) + "))")
+
+    return search_term_index
+
+
+def find_search_terms(sd, search_term_index):
+    """
+    Returns the set of search terms that appear in sd (see create_search_term_index).
+    """
+    if search_term_index["pattern"] is None:
+        return set()
+    return {
+        term for match in search_term_index["pattern"].finditer(sd)
+        for term in search_term_index["prefixes"][match.group(1)]
+    }
+
+
+def protocol_path(path):
+    """
+    Returns path with its subject and session labels removed, so that the same protocol uploaded for several
+    subjects/sessions (e.g. in a BIDS-compliant upload) has the same signature.
+    """
+    return re.sub(r"(sub|ses)-[a-zA-Z0-9]+", r"\1-", path)
+
+
+def datatype_suffix_signature(unique_dic, dataset_list_unique_series, index):
+    """
+    Protocol signature of a unique series, i.e. everything datatype_suffix_identification (including the
+    lookup_dic conditions) reads to classify it. Needs updating whenever those read something new.
+
+    Returns
+    -------
+    signature : string
+    """
+    sidecar = unique_dic["sidecar"]
+    return json.dumps([
+        protocol_path(unique_dic["json_path"]),
+        "_i0000" in unique_dic["paths"][0],
+        any(".bvec" in x for x in unique_dic["paths"]),
+        unique_dic["descriptor"],
+        unique_dic[unique_dic["descriptor"]],
+        unique_dic["ImageType"],
+        unique_dic["EchoTime"],
+        unique_dic["RepetitionTime"],
+        unique_dic["EchoNumber"],
+        unique_dic["ndim"],
+        unique_dic["NumVolumes"],
+        unique_dic["Modality"],
+        sidecar.get("BidsGuess"),
+        sidecar.get("Manufacturer"),
+        sidecar.get("ConversionSoftware"),
+        [x in sidecar for x in ["EchoNumber", "InversionTime", "FlipAngle"]],
+        [unique_dic[x] for x in ["type", "datatype", "suffix", "message", "error"]],
+        # the phasediff and phase2 conditions look at the series two before this one (when there are more than 2)
+        len(dataset_list_unique_series) > 2,
+        len(dataset_list_unique_series) > 2 and "_e1_ph" in dataset_list_unique_series[index - 2]["json_path"]
+    ], default=str)
+
+
+def entity_signature(unique_dic):
+    """
+    Protocol signature of a unique series, i.e. everything entity_labels_identification reads to determine
+    its entity labels. Returns None for series whose entity labels also depend on the other series
+    (numbered TB1AFI/TB1SRGE acquisitions, MEG calibration/crosstalk files).
+
+    Returns
+    -------
+    signature : string or None
+    """
+    sidecar = unique_dic["sidecar"]
+    if (any(x in unique_dic["type"] for x in ["fmap/TB1AFI", "fmap/TB1SRGE"])
+            or sidecar["Manufacturer"] in ["Elekta", "Neuromag", "MEGIN"]):
+        return None
+    return json.dumps([
+        protocol_path(unique_dic["json_path"]),
+        unique_dic["descriptor"],
+        unique_dic[unique_dic["descriptor"]],
+        unique_dic["SeriesDescription"],
+        unique_dic["type"],
+        unique_dic["datatype"],
+        unique_dic["suffix"],
+        unique_dic["direction"],
+        unique_dic["EchoNumber"],
+        unique_dic["ImageType"],
+        [x in sidecar for x in ["FlipAngle", "DelayTime", "InversionTime"]],
+        sidecar.get("ReceiveCoilName")
+    ], default=str)
+
+
+class ClassificationMemo:
+    """
+    Results of datatype_suffix_identification and entity_labels_identification per protocol signature, so
+    that a protocol repeated across the upload (e.g. every subject of a BIDS-compliant dataset) is only
+    classified once. Backed by the persistent classification cache (see classification_cache.py), if given,
+    so protocols classified by previous sessions aren't classified again either.
+    """
+
+    def __init__(self, cache=None):
+        self.results = {}
+        self.cache = cache
+        self.hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    def get(self, stage, signature):
+        """
+        Returns a copy of the result stored for signature by stage, or None.
+        """
+        if signature is None:
+            return None
+        result = self.results.get((stage, signature))
+        if result is None and self.cache is not None:
+            result = self.cache.get(stage, signature)
+            if result is not None:
+                self.cache_hits += 1
+                self.results[(stage, signature)] = result
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.copy_result(result)
+
+    def put(self, stage, signature, result):
+        if signature is not None:
+            self.results[(stage, signature)] = self.copy_result(result)
+            if self.cache is not None:
+                self.cache.put(stage, signature, result)
+
+    @staticmethod
+    def copy_result(result):
+        # results hold strings, None and flat dictionaries (entities), which later steps modify per series
+        return {key: dict(value) if isinstance(value, dict) else value for key, value in result.items()}
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0
+        return f"Series classification memo: {self.hits} hits ({self.cache_hits} from the classification cache), " \
+            f"{self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+
 def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, config):
     """
     Uses metadata to try to determine the identity (i.e. datatype and suffix)
@@ -2287,7 +2827,19 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
     ezBIDS will attempt to determine datatype and suffix labels based on
     common keys/labels.
     """
+    suffix_index = create_suffix_index()
+    search_term_index = create_search_term_index(lookup_dic)
+
     for index, unique_dic in enumerate(dataset_list_unique_series):
+        # Series with the same protocol signature as one that has already been classified are classified the same
+        signature = None
+        if unique_dic["finalized_match"] is False:
+            signature = datatype_suffix_signature(unique_dic, dataset_list_unique_series, index)
+            memo = classification_memo.get("datatype_suffix", signature)
+            if memo is not None:
+                unique_dic.update(memo)
+                continue
+
         # Not ideal using json_path because it's only the first sequence in the series_idx group...
         json_path = unique_dic["json_path"]
 
@@ -2297,59 +2849,22 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
             unique_dic["message"] = unique_dic["error"]
         elif unique_dic["finalized_match"] is False:
             # Try checking the json paths themselves for explicit information regarding datatype and suffix
+            # (i.e. the "<suffix>" in "_<suffix>.json")
+            json_path_labels = set(re.findall(r"_([^_]*?)\.json", json_path))
             for datatype in datatypes_yaml:
                 if f"/{datatype}/" in json_path:
                     unique_dic["datatype"] = datatype
 
-                rule = yaml.load(open(os.path.join(analyzer_dir, datatype_suffix_rules, datatype) + ".yaml"),
-                                 Loader=yaml.FullLoader)
-
-                suffixes = [x for y in [rule[x]["suffixes"] for x in rule] for x in y]
-
-                short_suffixes = [x for x in suffixes if len(x) < 3]
-
-                unhelpful_suffixes = [
-                    "fieldmap",
-                    "beh",
-                    "epi",
-                    "magnitude",
-                    "magnitude1",
-                    "magnitude2",
-                    "phasediff"
-                ]
-
-                bad_suffixes = short_suffixes + unhelpful_suffixes
-
-                # Remove deprecated suffixes
-                deprecated_suffixes = ["T2star", "FLASH", "PD", "phase"]
-                suffixes = [x for x in suffixes if x not in deprecated_suffixes]
+                suffixes = suffix_index["suffixes"][datatype]
+                for suffix in sorted(json_path_labels.intersection(suffixes), key=suffixes.get):
+                    unique_dic["suffix"] = suffix
 
-                for suffix in suffixes:
-                    if f"_{suffix}.json" in json_path:
-                        unique_dic["suffix"] = suffix
+                bad_suffixes = suffix_index["bad_suffixes"][datatype]
+                for bad_suffix in sorted(json_path_labels.intersection(bad_suffixes), key=bad_suffixes.get):
+                    if bad_suffix in suffix_index["bad_suffix_datatypes"]:
+                        unique_dic["datatype"] = suffix_index["bad_suffix_datatypes"][bad_suffix]
 
-                for bad_suffix in bad_suffixes:
-                    if f"_{bad_suffix}.json" in json_path:
-                        if bad_suffix == "fieldmap":
-                            unique_dic["datatype"] = "fmap"
-                        elif bad_suffix == "beh":
-                            unique_dic["datatype"] = "beh"
-                        elif bad_suffix == "epi":
-                            unique_dic["datatype"] = "fmap"
-                        elif bad_suffix == "magnitude":
-                            unique_dic["datatype"] = "fmap"
-                        elif bad_suffix == "magnitude1":
-                            unique_dic["datatype"] = "fmap"
-                        elif bad_suffix == "magnitude2":
-                            unique_dic["datatype"] = "fmap"
-                        elif bad_suffix == "phasediff":
-                            unique_dic["datatype"] = "fmap"
-                        elif bad_suffix == "PC":
-                            unique_dic["datatype"] = "micr"
-                        elif bad_suffix == "DF":
-                            unique_dic["datatype"] = "micr"
-
-                        unique_dic["suffix"] = bad_suffix
+                    unique_dic["suffix"] = bad_suffix
 
                 # Correct BIDS deprecation issue, func/phase no long exists, now func/bold part-phase
                 if unique_dic["datatype"] == "func" and unique_dic["suffix"] == "phase":
@@ -2386,9 +2901,8 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
                 if len(bids_guess) == 2:  # should always be length of 2, but just to be safe
                     datatype = str(bids_guess[0]).lower()  # in case BidsGuess doesn't make datatype lowercase
                     suffix = bids_guess[1].split("_")[-1]
-                    for bids_ref_suffix in suffixes_yaml:  # in case BidsGuess not use proper suffix case format (e.g PET)
-                        if bids_ref_suffix != suffix and bids_ref_suffix.lower() == suffix.lower():
-                            suffix = bids_ref_suffix
+                    # in case BidsGuess not use proper suffix case format (e.g PET)
+                    suffix = suffix_index["suffix_case"].get(suffix.lower(), suffix)
                     # Issue with BidsGuess and func/sbref identification
                     if suffix == "bold":
                         descriptor = unique_dic["descriptor"]
@@ -2397,7 +2911,7 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
                         if "sbref" in sd and unique_dic["NumVolumes"] == 1:
                             suffix = "sbref"
 
-                    if datatype.lower() not in [x for x in datatypes_yaml.keys()]:  # assumed to be non-BIDS data
+                    if datatype.lower() not in datatypes_yaml:  # assumed to be non-BIDS data
                         if suffix in ["localizer", "scout"] or "_i0000" in unique_dic["paths"][0]:
                             # localizer
                             unique_dic["message"] = "Acquisition was determined to be a localizer sequence, " \
@@ -2431,82 +2945,87 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
                 sd = re.sub("[^A-Za-z0-9]+", "_", sd).lower() + "_"
                 # sd_sparse = re.sub("[^A-Za-z0-9]+", "", sd)
 
-                cont = True
-                for datatype in lookup_dic.keys():
+                """
+                Only the datatype/suffix pairs with a search term in sd can match, along with localizers (which
+                can also be identified by their paths) and dwi (by its bval/bvec files). Check them in the
+                order they're listed in lookup_dic, the first pair whose conditions are all met wins.
+                """
+                found_terms = find_search_terms(sd, search_term_index)
+                candidate_rules = {rule for term in found_terms for rule in search_term_index["rules"][term]}
+                candidate_rules.update(x for x in [search_term_index["localizer"], search_term_index["dwi"]] if x)
+
+                for _, datatype, suffix in sorted(candidate_rules):
+                    search_terms = lookup_dic[datatype][suffix]["search_terms"]
+                    search_hits = [x for x in search_terms if x in found_terms]
                     if datatype not in ["localizer", "dwi_derivatives"]:
-                        suffixes = lookup_dic[datatype].keys()
-                        for suffix in suffixes:
-                            search_terms = lookup_dic[datatype][suffix]["search_terms"]
-                            conditions = lookup_dic[datatype][suffix]["conditions"]
-                            eval_checks = [eval(t, {"sd": sd,
-                                                    "unique_dic": unique_dic,
-                                                    "dataset_list_unique_series": dataset_list_unique_series,
-                                                    "index": index
-                                                    }) for t in conditions]
-                            if any(x in sd for x in search_terms):
-                                # Search term match
-                                conditions = [
-                                    (x.replace("unique_dic", "").replace('["', "").replace('"]', "").
-                                        replace("dataset_list_unique_series[index - 2]", "")) for x in conditions
-                                ]
-                                search_hit = [x for x in search_terms if re.findall(x, sd)][0]
-
-                                if len([t for t in eval_checks if t is True]) == len(conditions):
-                                    # Search term match, as well as all necessary conditions for datatype/suffix pair
-                                    unique_dic["datatype"] = datatype
-                                    unique_dic["suffix"] = suffix
-                                    unique_dic["type"] = ""
-                                    if len(conditions):
-                                        condition_passes = [
-                                            f"({index+1}): {value}" for index, value in enumerate(conditions)
-                                        ]
-                                        unique_dic["message"] = f"Acquisition is believed to be {datatype}/{suffix} " \
-                                            f"because '{search_hit}' is in the {unique_dic['descriptor']} and the " \
-                                            f"following conditions are met: {condition_passes}. " \
-                                            "Please modify if incorrect."
-                                    else:
-                                        unique_dic["message"] = f"Acquisition is believed to be {datatype}/{suffix} " \
-                                            f"because '{search_hit}' is in the {unique_dic['descriptor']}. " \
-                                            "Please modify if incorrect."
-                                    cont = False
-                                    break
-                                else:
-                                    unique_dic["type"] = "exclude"
-                                    condition_fails_ind = [i for (i, v) in enumerate(eval_checks) if v is False]
-                                    condition_fails = [v for (i, v) in enumerate(conditions) if i in condition_fails_ind]
-                                    condition_fails = [
-                                        f"({index+1}): {value}" for index, value in enumerate(condition_fails)
-                                    ]
-
-                                    if (datatype in ["func", "dwi"]
-                                            and (unique_dic["ndim"] == 3 and unique_dic["NumVolumes"] > 1)):
-                                        """
-                                        func and dwi can also have sbref suffix pairings, so 3D dimension data with
-                                        only a single volume likely indicates that the sequence was closer to being
-                                        identified as a func (or dwi) sbref.
-                                        """
-                                        suffix = "sbref"
-
-                                    unique_dic["message"] = f"Acquisition was thought to be {datatype}/{suffix} " \
-                                        f"because '{search_hit}' is in the {unique_dic['descriptor']}, but the " \
-                                        f"following conditions were not met: {condition_fails}. Please modify " \
-                                        "if incorrect."
-
-                            elif datatype == "dwi" and suffix == "dwi" and any(".bvec" in x for x in unique_dic["paths"]):
+                        conditions = lookup_dic[datatype][suffix]["conditions"]
+                        eval_checks = [
+                            t(sd, unique_dic, dataset_list_unique_series, index)
+                            for t in lookup_dic[datatype][suffix]["predicates"]
+                        ]
+                        if len(search_hits):
+                            # Search term match
+                            conditions = [
+                                (x.replace("unique_dic", "").replace('["', "").replace('"]', "").
+                                    replace("dataset_list_unique_series[index - 2]", "")) for x in conditions
+                            ]
+                            search_hit = search_hits[0]
+
+                            if len([t for t in eval_checks if t is True]) == len(conditions):
+                                # Search term match, as well as all necessary conditions for datatype/suffix pair
                                 unique_dic["datatype"] = datatype
                                 unique_dic["suffix"] = suffix
-                                unique_dic["message"] = f"Acquisition is believed to be {datatype}/{suffix} " \
-                                    "because associated bval/bvec files were found for this sequence. " \
-                                    "Please modify if incorrect."
-                        if cont is False:
-                            break
+                                unique_dic["type"] = ""
+                                if len(conditions):
+                                    condition_passes = [
+                                        f"({index+1}): {value}" for index, value in enumerate(conditions)
+                                    ]
+                                    unique_dic["message"] = f"Acquisition is believed to be {datatype}/{suffix} " \
+                                        f"because '{search_hit}' is in the {unique_dic['descriptor']} and the " \
+                                        f"following conditions are met: {condition_passes}. " \
+                                        "Please modify if incorrect."
+                                else:
+                                    unique_dic["message"] = f"Acquisition is believed to be {datatype}/{suffix} " \
+                                        f"because '{search_hit}' is in the {unique_dic['descriptor']}. " \
+                                        "Please modify if incorrect."
+                                break
+                            else:
+                                unique_dic["type"] = "exclude"
+                                condition_fails_ind = [i for (i, v) in enumerate(eval_checks) if v is False]
+                                condition_fails = [v for (i, v) in enumerate(conditions) if i in condition_fails_ind]
+                                condition_fails = [
+                                    f"({index+1}): {value}" for index, value in enumerate(condition_fails)
+                                ]
+
+                                if (datatype in ["func", "dwi"]
+                                        and (unique_dic["ndim"] == 3 and unique_dic["NumVolumes"] > 1)):
+                                    """
+                                    func and dwi can also have sbref suffix pairings, so 3D dimension data with
+                                    only a single volume likely indicates that the sequence was closer to being
+                                    identified as a func (or dwi) sbref.
+                                    """
+                                    suffix = "sbref"
+
+                                unique_dic["message"] = f"Acquisition was thought to be {datatype}/{suffix} " \
+                                    f"because '{search_hit}' is in the {unique_dic['descriptor']}, but the " \
+                                    f"following conditions were not met: {condition_fails}. Please modify " \
+                                    "if incorrect."
+
+                        elif datatype == "dwi" and suffix == "dwi" and any(".bvec" in x for x in unique_dic["paths"]):
+                            unique_dic["datatype"] = datatype
+                            unique_dic["suffix"] = suffix
+                            unique_dic["message"] = f"Acquisition is believed to be {datatype}/{suffix} " \
+                                "because associated bval/bvec files were found for this sequence. " \
+                                "Please modify if incorrect."
                     else:
                         # Localizers
                         if datatype == "localizer":
-                            search_terms = lookup_dic[datatype]["exclude"]["search_terms"]
                             conditions = lookup_dic["localizer"]["exclude"]["conditions"]
-                            eval_checks = [eval(t, {"sd": sd, "unique_dic": unique_dic}) for t in conditions]
-                            if (any(x in sd for x in search_terms)
+                            eval_checks = [
+                                t(sd, unique_dic, dataset_list_unique_series, index)
+                                for t in lookup_dic["localizer"]["exclude"]["predicates"]
+                            ]
+                            if (len(search_hits)
                                     or len([t for t in eval_checks if t]) == len(conditions)):
                                 unique_dic["type"] = "exclude"
                                 unique_dic["error"] = "Acquisition appears to be a localizer"
@@ -2515,10 +3034,12 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
                                     "modify if incorrect."
                         # DWI derivatives (TRACEW, FA, ADC)
                         elif datatype == "dwi_derivatives":
-                            search_terms = lookup_dic[datatype]["exclude"]["search_terms"]
                             conditions = lookup_dic["dwi_derivatives"]["exclude"]["conditions"]
-                            eval_checks = [eval(t, {"sd": sd, "unique_dic": unique_dic}) for t in conditions]
-                            if (any(x in sd for x in search_terms)
+                            eval_checks = [
+                                t(sd, unique_dic, dataset_list_unique_series, index)
+                                for t in lookup_dic["dwi_derivatives"]["exclude"]["predicates"]
+                            ]
+                            if (len(search_hits)
                                     and len([t for t in eval_checks if t]) == len(conditions)):
                                 unique_dic["type"] = "exclude"
                                 unique_dic["error"] = "Acquisition appears to be a TRACEW, FA, or " \
@@ -2573,6 +3094,10 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
                 "combined RMS file. If the RMS file exists it is ideal to exclude this "
                 "acquisition and only save the RMS file, not the individual echoes.")
 
+        classification_memo.put(
+            "datatype_suffix", signature, {x: unique_dic[x] for x in ["datatype", "suffix", "type", "message", "error"]}
+        )
+
     """
     If there's multi-echo anatomical data and we have the mean (RMS) file, exclude the
     individual echo sequences, since the BIDs validator will generate an error with them.
@@ -2586,6 +3111,7 @@ def datatype_suffix_identification(dataset_list_unique_series, lookup_dic, confi
 
         if len(anat_ME_RMS):
             for anat_ME_RMS_index in anat_ME_RMS:
+                descriptor = dataset_list_unique_series[anat_ME_RMS_index]["descriptor"]
                 sd = dataset_list_unique_series[anat_ME_RMS_index][descriptor]
                 anat_ind_ME_indices = [
                     x for (x, v) in enumerate(dataset_list_unique_series)
@@ -2629,12 +3155,17 @@ def entity_labels_identification(dataset_list_unique_series, lookup_dic):
     print("")
     print("Entity label identification")
     print("----------------------------")
-    entity_ordering = yaml.load(open(os.path.join(analyzer_dir, entity_ordering_file)), Loader=yaml.FullLoader)
 
     tb1afi_tr = 1
     tb1srge_td = 1
     for unique_dic in dataset_list_unique_series:
         if unique_dic["finalized_match"] is False:
+            # Series with the same protocol signature as one that has already been labeled get the same labels
+            signature = entity_signature(unique_dic)
+            memo = classification_memo.get("entities", signature)
+            if memo is not None:
+                unique_dic.update(memo)
+                continue
 
             series_entities = {}
             descriptor = unique_dic["descriptor"]
@@ -2668,16 +3199,13 @@ def entity_labels_identification(dataset_list_unique_series, lookup_dic):
             if any(x in func_rest_keys for x in sd.split('_')) and not series_entities["task"]:
                 series_entities["task"] = "rest"
             else:
-                match_index = [
-                    x for x, y in enumerate(re.search(x, sd, re.IGNORECASE) for x in cog_atlas_tasks) if y is not None
-                ]
-                if len(match_index):
-                    task_name = cog_atlas_tasks[match_index[0]]
+                task_name = cog_atlas_task_matcher.first_match(sd)
+                if task_name is not None:
                     if len(task_name) < 4:  # Too many possible false positives with short task names
                         if any(f"task-{task_name}" in x for x in [unique_dic["json_path"], unique_dic["SeriesDescription"]]):
-                            series_entities["task"] = cog_atlas_tasks[match_index[0]]
+                            series_entities["task"] = task_name
                     else:
-                        series_entities["task"] = cog_atlas_tasks[match_index[0]]
+                        series_entities["task"] = task_name
 
             if (any(x in re.sub("[^A-Za-z0-9]+", "", sd).lower() for x in ["noise", "emptyroom"])
                     or series_entities["subject"] == "emptyroom"):  # for MEG data
@@ -2799,6 +3327,8 @@ def entity_labels_identification(dataset_list_unique_series, lookup_dic):
 
             unique_dic["entities"] = series_entities
 
+            classification_memo.put("entities", signature, {"entities": series_entities})
+
     return dataset_list_unique_series
 
 
@@ -2859,16 +3389,17 @@ def update_dataset_list(dataset_list, dataset_list_unique_series):
         A modified version of dataset_list, where this list contains only the
         dictionaries of acquisitions with a unique series group ID.
     """
-    for unique_dic in dataset_list_unique_series:
-        for data in dataset_list:
-            if data["series_idx"] == unique_dic["series_idx"]:
-                data["entities"] = unique_dic["entities"]
-                data["type"] = unique_dic["type"]
-                data["error"] = unique_dic["error"]
-                data["message"] = unique_dic["message"]
-                data["IntendedFor"] = unique_dic["IntendedFor"]
-                data["B0FieldIdentifier"] = unique_dic["B0FieldIdentifier"]
-                data["B0FieldSource"] = unique_dic["B0FieldSource"]
+    unique_series = {unique_dic["series_idx"]: unique_dic for unique_dic in dataset_list_unique_series}
+    for data in dataset_list:
+        unique_dic = unique_series.get(data["series_idx"])
+        if unique_dic is not None:
+            data["entities"] = unique_dic["entities"]
+            data["type"] = unique_dic["type"]
+            data["error"] = unique_dic["error"]
+            data["message"] = unique_dic["message"]
+            data["IntendedFor"] = unique_dic["IntendedFor"]
+            data["B0FieldIdentifier"] = unique_dic["B0FieldIdentifier"]
+            data["B0FieldSource"] = unique_dic["B0FieldSource"]
 
     return dataset_list
 
@@ -2892,18 +3423,11 @@ def modify_objects_info(dataset_list):
     """
     objects_list = []
 
-    entity_ordering = yaml.load(open(os.path.join(analyzer_dir, entity_ordering_file)), Loader=yaml.FullLoader)
+    # Group acquisitions by subject/session idx pairs and sort them
+    subj_ses_groups = group_acquisitions(dataset_list, ["subject_idx", "session_idx"])
 
-    # Find unique subject/session idx pairs in dataset and sort them
-    subj_ses_pairs = [[x["subject_idx"], x["session_idx"]] for x in dataset_list]
-    unique_subj_ses_pairs = sorted([list(i) for i in set(tuple(i) for i in subj_ses_pairs)])
-
-    for unique_subj_ses in unique_subj_ses_pairs:
-        scan_protocol = [
-            x for x in dataset_list
-            if x["subject_idx"] == unique_subj_ses[0]
-            and x["session_idx"] == unique_subj_ses[1]
-        ]
+    for unique_subj_ses in sorted(subj_ses_groups):
+        scan_protocol = subj_ses_groups[unique_subj_ses]
 
         objects_data = []
 
@@ -2912,14 +3436,13 @@ def modify_objects_info(dataset_list):
         additional information.
         """
         for protocol in scan_protocol:
-            if protocol["nibabel_image"] == "n/a":
+            if protocol["nifti_header"] == "n/a":
                 protocol["headers"] = "n/a"
             else:
-                image = protocol["nibabel_image"]
-                protocol["headers"] = str(image.header).splitlines()[1:]
+                nifti_header = protocol["nifti_header"]
+                protocol["headers"] = nifti_header.header_text()
 
-                object_img_array = image.dataobj
-                if object_img_array.dtype not in ["<i2", "<u2", "<f4", "int16", "uint16"]:
+                if nifti_header.dtype not in ["<i2", "<u2", "<f4", "int16", "uint16"]:
                     # Weird edge case where data array is RGB instead of integer
                     protocol["exclude"] = True
                     protocol["error"] = "The data array for this " \
@@ -2931,7 +3454,7 @@ def modify_objects_info(dataset_list):
                     protocol["type"] = "exclude"
 
                 # Check for negative dimensions and exclude from BIDS conversion if they exist
-                if len([x for x in image.shape if x < 0]):
+                if len([x for x in nifti_header.shape if x < 0]):
                     protocol["exclude"] = True
                     protocol["type"] = "exclude"
                     protocol["error"] = "Image contains negative dimension(s) and cannot be converted to BIDS format"
@@ -3104,6 +3627,9 @@ except:
         pd.read_csv("list", sep=' ', header=None, lineterminator='\n').to_numpy().flatten().tolist()
     )
 
+# List the upload's directories once, the steps below look files up in this index
+index_directories(".")
+
 # Remove dots in file names (that aren't extensions). This screws up the bids-validator otherwise
 uploaded_img_list = fix_multiple_dots(uploaded_img_list)
 
@@ -3113,8 +3639,9 @@ generate_MEG_json_sidecars(uploaded_img_list)
 # Filter uploaded files list for files that ezBIDS can't use and check for ezBIDS configuration file
 uploaded_files_list, exclude_data, config, config_file = modify_uploaded_dataset_list(uploaded_img_list)
 
-# # Generate list of all possible Cognitive Atlas task terms
-cog_atlas_tasks = find_cog_atlas_tasks(cog_atlas_url)
+# # Generate list of all possible Cognitive Atlas task terms (from a local copy, see cog_atlas.py)
+cog_atlas_tasks = load_cog_atlas_tasks()
+cog_atlas_task_matcher = TaskMatcher(cog_atlas_tasks)
 
 # Create the dataset list of dictionaries
 dataset_list = generate_dataset_list(uploaded_files_list, exclude_data)
@@ -3183,6 +3710,16 @@ else:
 # Generate lookup information directory to help with datatype and suffix identification (and to some degree, entities)
 lookup_dic = create_lookup_info()
 
+# Classification results of each protocol signature, shared by datatype/suffix and entity label identification.
+# Results persisted by previous sessions are reused as long as the schema and heuristics haven't changed since.
+classification_cache = open_classification_cache(cache_namespace(
+    loaded_schema_hash(),
+    Path(__file__).read_bytes(),
+    Path(__file__).with_name("cog_atlas.py").read_bytes(),
+    json.dumps(cog_atlas_tasks)
+))
+classification_memo = ClassificationMemo(classification_cache)
+
 # Identify datatype and suffix information
 dataset_list_unique_series = datatype_suffix_identification(dataset_list_unique_series, lookup_dic, config)
 
@@ -3245,4 +3782,7 @@ EZBIDS = {
 with open("ezBIDS_core.json", "w") as fp:
     json.dump(EZBIDS, fp, indent=3)
 
+print(classification_memo.summary())
+if classification_cache is not None:
+    classification_cache.close()
 print(f"--- Analyzer completion time: {time.perf_counter() - start_time} seconds ---")
@@ -3,9 +3,10 @@
 import os
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from pydicom import dcmread
 from presort_dicoms import presort
+from dicom_header_cache import open_cache, read_header
 
 parser = argparse.ArgumentParser(
     prog='FindImageData',
@@ -14,117 +15,245 @@ parser = argparse.ArgumentParser(
 parser.add_argument('root')
 
 
-# presort can slow down ezBIDS as it examines every dicom, it's enabled/disabled
+# presort examines every dicom (in parallel, see PRESORT_NJOBS in presort_dicoms.py), it's enabled/disabled
 # by setting the PRESORT environment variable to "true" or ""
 presort_enabled = bool(os.getenv('PRESORT', 'false').lower() == 'true')
 presort_enabled_pet = bool(os.getenv('PRESORT_PET', 'false').lower() == 'true')
 
+# directories are classified in parallel (reading DICOM headers is I/O bound, so threads are used),
+# the number of workers is set with the FIND_IMG_DATA_NJOBS environment variable
+find_img_data_njobs = max(1, int(os.getenv('FIND_IMG_DATA_NJOBS', '4')))
+
 
 # if pet2bids is installed we use it wherever the PET data live
 try:
-    # import pypet2bids
+    import pypet2bids  # noqa: F401
     pet2bidsInstalled = True
-    from pypet2bids import is_pet
 except (ImportError, ModuleNotFoundError):
     pet2bidsInstalled = False
     print('pet2bids is not installed, using dcm2niix on PET directories instead')
     # Don't exit, just continue without PET support
-    is_pet = None
+
+# Define common DICOM file extensions (lowercase)
+dicom_extensions = ('.dcm', '.ima', '.img', '')
+
+# ECAT-formatted PET
+ecat_extensions = ('.v', '.v.gz')
+
+# MEG files (.ds are directories), only looked for up to meg_maxdepth levels into the upload
+MEG_extensions = ('.ds', '.fif', '.sqd', '.con', '.raw', '.ave', '.mrk', '.kdf', '.mhd', '.trg', '.chn', '.dat')
+meg_maxdepth = 9
+
+# Only the tags needed to classify a directory are parsed, everything else (including pixel data) is skipped
+dicom_tags = ['Modality']
+
+# Once a directory is known to hold MR (or PET) data, at most this many more files are read to look for
+# the other modality (PET/MR hybrid scanners). They are spread evenly, so the other modality is always
+# found if its files are contiguous once sorted and make up at least 1/modality_probe_files of the rest
+modality_probe_files = 8
+
+
+def classify_directory(root, files):
+    '''
+    Determines the modalities of the DICOM files in a single directory. Files are read until the first MR or
+    PET file. A directory can hold both (PET/MR hybrid scanners), so when pet2bids is installed, up to
+    modality_probe_files more files, spread evenly over the rest of the directory, are read to look for the
+    other modality. Without pet2bids, PET is converted along with the MR data and no more files are read.
+    Safe to call from worker threads, log messages are returned rather than written.
+
+    Parameters
+    ----------
+    root : string
+        directory being classified
+
+    files : list
+        file names in root
+
+    Returns
+    -------
+    modalities : set
+        'MR' if an MR DICOM was found, 'PT' if a PET DICOM was found, 'other' for any other DICOMs,
+        empty if the directory contains no readable DICOM files
+
+    bytes_read : int
+        Number of bytes read from the files in this directory
+
+    log_lines : list
+        Messages destined for find_img_data.log
+    '''
+    modalities = set()
+    log_lines = []
+    bytes_read = 0
+
+    def read_modality(f):
+        nonlocal bytes_read
+        file_path = os.path.join(root, f)
+        try:
+            log_lines.append(f"Trying to read DICOM file: {file_path}\n")
+            header, file_bytes_read = read_header(file_path, dicom_tags, header_cache)
+            bytes_read += file_bytes_read
+            if header is None:
+                return
+            modality = header['Modality']
+            log_lines.append(f"DICOM Modality: {modality}\n")
+            modalities.add(modality if modality in ['MR', 'PT'] else 'other')
+        except Exception as e:
+            log_lines.append(f"Error reading DICOM file {f}: {str(e)}\n")
+
+    # Case-insensitive extension check
+    candidates = [f for f in sorted(files) if f.lower().endswith(dicom_extensions)]
+    for index, f in enumerate(candidates):
+        read_modality(f)
+        if 'MR' in modalities or 'PT' in modalities:
+            break
+
+    if pet2bidsInstalled and len(modalities & {'MR', 'PT'}) == 1:
+        # the files of each modality are usually contiguous once sorted, so don't probe the next few only
+        remaining = candidates[index + 1:]
+        step = max(1, -(-len(remaining) // modality_probe_files))
+        for f in remaining[::-step]:
+            read_modality(f)
+            if {'MR', 'PT'} <= modalities:
+                break
+
+    return modalities, bytes_read, log_lines
+
+
+def scan_upload(dir):
+    '''
+    Traverses the upload a single time with os.scandir, dispatching every entry to the modality it could
+    belong to: candidate DICOM files are grouped per directory (MRI/PET classification), ECAT files are
+    PET and files/directories with MEG extensions are MEG. MEG .ds directories are datasets in their own
+    right, so they aren't descended into.
+
+    Parameters
+    ----------
+    dir : string
+        root-level directory of uploaded data
+
+    Returns
+    -------
+    dicom_dirs : list
+        (directory, candidate DICOM file names) tuples, in sorted traversal order
+
+    ecat_files : list
+        paths of ECAT-formatted PET files
+
+    meg_files : list
+        paths of MEG files (and .ds directories)
+    '''
+    dicom_dirs = []
+    ecat_files = []
+    meg_files = []
+
+    stack = [(dir, 0)]
+    while stack:
+        root, depth = stack.pop()
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        dicom_candidates = []
+        sub_dirs = []
+        for entry in entries:
+            path = os.path.join(root, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name.endswith('.ds'):
+                    if depth < meg_maxdepth:
+                        meg_files.append(path)
+                else:
+                    sub_dirs.append((path, depth + 1))
+            elif entry.is_file():
+                if entry.name.endswith(ecat_extensions):
+                    ecat_files.append(path)
+                elif entry.name.endswith(MEG_extensions):
+                    if depth < meg_maxdepth:
+                        meg_files.append(path)
+                elif entry.name.lower().endswith(dicom_extensions):
+                    dicom_candidates.append(entry.name)
+
+        dicom_dirs.append((root, dicom_candidates))
+        # push in reverse so directories are popped (and listed) in sorted order
+        stack.extend(reversed(sub_dirs))
+
+    meg_files = [x for x in meg_files if 'hz.ds' not in x]
+
+    return dicom_dirs, ecat_files, meg_files
+
 
 def find_img_data(dir):
     '''
-    Finds all directories that contain DICOM (or other) raw imaging data.
+    Finds all directories that contain DICOM (or other) raw imaging data, as well as ECAT and MEG files.
     If dcm2niix output (NIfTI, JSON files) uploaded instead, ezBIDS has separate process for detecting those files.
+    The upload is traversed exactly once and only DICOM headers are read. Directories are classified
+    by a pool of find_img_data_njobs workers, results are merged in (sorted) traversal order so the output
+    is the same regardless of the number of workers.
 
     Parameters
     ----------
     dir : string
         root-level directory of uploaded data
     '''
-    global mri_dcm_dirs_list
-    hasImgData = False
-
-    # Define common DICOM file extensions (lowercase)
-    dicom_extensions = ('.dcm', '.ima', '.img', '')
-
-    with open('find_img_data.log', 'a+') as log:
-        # MRI (raw only)
-        for root, dirs, files in os.walk(dir):
-            for f in sorted(files):
-                # Case-insensitive extension check
-                if any(f.lower().endswith(ext) for ext in dicom_extensions):
-                    try:
-                        log.write(f"Trying to read DICOM file: {os.path.join(root, f)}\n")
-                        read_file = dcmread(os.path.join(root, f))
-                        log.write(f"DICOM Modality: {read_file.Modality}\n")
-                        if read_file.Modality == 'MR':
-                            if root not in mri_dcm_dirs_list:
-                                log.write(f"Found MRI directory: {root}\n")
-                                mri_dcm_dirs_list.append(root)
-                                hasImgData = True
-                                break
-                    except Exception as e:
-                        log.write(f"Error reading DICOM file {f}: {str(e)}\n")
-                        continue
-
-        # Complete search
-        if not hasImgData:
-            for x in sorted(os.listdir(dir)):
-                full_path = os.path.join(dir, x)
-                if os.path.isdir(full_path):
-                    find_img_data(full_path)
+    total_bytes_read = 0
+
+    dicom_dirs, ecat_files, meg_files = scan_upload(dir)
+
+    with open('find_img_data.log', 'a+') as log, ThreadPoolExecutor(max_workers=find_img_data_njobs) as executor:
+        results = executor.map(lambda dicom_dir: classify_directory(*dicom_dir), dicom_dirs)
+        for (root, files), (modalities, bytes_read, log_lines) in zip(dicom_dirs, results):
+            log.writelines(log_lines)
+            total_bytes_read += bytes_read
+            dcm_dirs_modalities[root] = modalities
+            # MRI (raw only)
+            if 'MR' in modalities and root not in mri_dcm_dirs_list:
+                log.write(f"Found MRI directory: {root}\n")
+                mri_dcm_dirs_list.append(root)
+            # PET DICOMs are handed to pet2bids if it's available (PET/MR directories go to both lists),
+            # otherwise dcm2niix converts them
+            if 'PT' in modalities:
+                if pet2bidsInstalled and root not in pet_dcm_dirs_list:
+                    log.write(f"Found PET directory: {root}\n")
+                    pet_dcm_dirs_list.append(root)
+                elif not pet2bidsInstalled and root not in mri_dcm_dirs_list:
+                    log.write(f"Found PET directory (converting with dcm2niix): {root}\n")
+                    mri_dcm_dirs_list.append(root)
+
+        log.write(f"Read {total_bytes_read} bytes of DICOM header data from {len(dcm_dirs_modalities)} directories\n")
+        if header_cache is not None:
+            log.write(f"DICOM header cache: {header_cache.hits} hits, {header_cache.misses} misses\n")
+
+        # PET (ECAT-formatted)
+        if pet2bidsInstalled:
+            for ecat in ecat_files:
+                if ecat not in pet_ecat_files_list:
+                    log.write(f"Found ECAT file: {ecat}\n")
+                    pet_ecat_files_list.append(ecat)
+        elif len(ecat_files):
+            log.write(f"Skipping {len(ecat_files)} ECAT file(s), pet2bids is not installed\n")
+
+        # MEG
+        for meg in meg_files:
+            log.write(f"Found MEG data: {meg}\n")
+            meg_data_list.append(meg)
+
 
 # change to input directory
 root = sys.argv[1]
 os.chdir(root)
 
 mri_dcm_dirs_list = []
+dcm_dirs_modalities = {}
 pet_ecat_files_list = []
 pet_dcm_dirs_list = []
 meg_data_list = []
 
 root_full_path = str(Path(root).absolute())
 
+# parsed DICOM headers are shared across sessions, so re-uploaded data isn't parsed again
+header_cache = open_cache()
+
 # Actually call find_img_data with the root directory
 find_img_data('.')
 
-# PET
-pet_folders = [str(folder) for folder in is_pet.pet_folder(Path(root).resolve(), skim=True, njobs=4)]
-pet_folders = [os.path.relpath(x, root) for x in pet_folders if x != '']
-pet_folders = [os.path.join('.', x) for x in pet_folders]
-
-if pet_folders:
-    for pet in pet_folders:
-        # See if we're dealing ECAT-formatted file(s)
-        ecats = [x for x in os.listdir(pet) if x.endswith(tuple(['.v', '.v.gz']))]
-        if len(ecats):
-            for ecat in ecats:
-                if ecat not in pet_ecat_files_list:
-                    pet_ecat_files_list.append(f'{pet}/{ecat}')
-        # See if we're dealing with DICOM files
-        dcms = [
-            x for x in os.listdir(pet)
-            if not x.endswith(tuple(['.nii', '.nii.gz', '.v', '.v.gz', '.json', '.tsv']))
-        ]
-        if len(dcms) and pet not in pet_dcm_dirs_list:
-            pet_dcm_dirs_list.append(pet)
-
-# MEG
-MEG_extensions = ['*.ds', '*.fif', '*.sqd', '*.con', '*.raw', '*.ave', '*.mrk', '*.kdf', '*.mhd', '*.trg', '*.chn', '*.dat']
-for meg_ext in MEG_extensions:
-    if meg_ext == '*.ds':
-        type_search = 'd'
-    else:
-        type_search = 'f'
-
-    find_cmd = os.popen(f"find . -maxdepth 9 -type {type_search} -name '{meg_ext}'").read()
-    if find_cmd != '':
-        meg_data_list.append(find_cmd)
-
-if len(meg_data_list):
-    # TODO - won't this remove different extensions?
-    meg_data_list = [x for x in meg_data_list[0].split('\n') if x != '' and 'hz.ds' not in x]
-
 # Save the MRI, PET, MEG, and NIfTI lists (if they exist) to separate files
 file = open(f'{root}/dcm2niix.list', 'w')
 if len(mri_dcm_dirs_list):
@@ -132,7 +261,7 @@ if len(mri_dcm_dirs_list):
     sorted_mri_dirs = sorted(mri_dcm_dirs_list)
     for dcm in sorted_mri_dirs:
         if presort_enabled:
-            presorted_dicoms = sorted(presort(dcm))  # Sort presorted results too
+            presorted_dicoms = sorted(presort(dcm, cache=header_cache))  # Sort presorted results too
             for pre in presorted_dicoms:
                 file.write(str(pre) + '\n')
         else:
@@ -145,7 +274,7 @@ if len(pet_dcm_dirs_list):
     sorted_pet_dirs = sorted(pet_dcm_dirs_list)
     for dcm in sorted_pet_dirs:
         if presort_enabled:
-            presorted_folders = sorted(presort(dcm))  # Sort presorted results too
+            presorted_folders = sorted(presort(dcm, cache=header_cache))  # Sort presorted results too
             for pre in presorted_folders:
                 file.write(str(pre) + '\n')
         else:
@@ -163,3 +292,6 @@ if len(meg_data_list):
     for meg in meg_data_list:
         file.write(meg + '\n')
     file.close()
+
+if header_cache is not None:
+    header_cache.close()
@@ -2,22 +2,12 @@ import os
 import time
 import subprocess
 import re
-import contextlib
-import io
-import sys
-from pydicom import dcmread
+from dicom_header_cache import open_cache, read_header
 from pathlib import Path
 from datetime import datetime
 import shutil
 import argparse
-
-@contextlib.contextmanager
-def nostdout():
-    """Suppress stdout temporarily"""
-    save_stdout = sys.stdout
-    sys.stdout = io.StringIO()
-    yield
-    sys.stdout = save_stdout
+from concurrent.futures import ThreadPoolExecutor
 
 def is_potential_dicom(file_path):
     """
@@ -53,89 +43,193 @@ def find_dicom_files(folder_path):
     return [f for f in folder_path.iterdir() if f.is_file() and is_potential_dicom(f)]
 
 
-def inspect_dicoms(source_folder):
+# header tags needed to organize DICOMs into subjects/sessions, nothing else is parsed
+presort_tags = ['PatientID', 'PatientName', 'StudyDate']
+
+# headers are parsed by a pool of workers, the number of workers is set with the PRESORT_NJOBS environment variable
+presort_njobs = max(1, int(os.getenv('PRESORT_NJOBS', '4')))
+
+# DICOMs are moved here, grouped by subject/session, as soon as their header is parsed
+staging_folder_name = '.presort_staging'
+
+
+def parse_dicom(dicom_file, cache=None):
+    """
+    Determine the subject and session a DICOM file belongs to from its header.
+
+    Args:
+        dicom_file (Path): Path to the DICOM file
+        cache (DicomHeaderCache): Optional header cache
+
+    Returns:
+        tuple: ((subject_id, session_id), None) on success, (None, exception) on failure
+    """
+    try:
+        header, _ = read_header(str(dicom_file), presort_tags, cache)
+        if header is None:
+            raise ValueError("File is missing the DICOM preamble/DICM prefix")
+
+        # Get patient ID (fall back to patient name if ID not available)
+        patient_id = header['PatientID'] or header['PatientName']
+        if patient_id is None:
+            patient_id = 'unknown_patient'
+        patient_id = str(patient_id).replace('^', '_')  # Clean up potential special characters
+        subject_id = f'sub-{patient_id}'
+
+        # Get study date and convert to ISO format
+        study_date = header['StudyDate']
+        if study_date:
+            try:
+                date_obj = datetime.strptime(study_date, '%Y%m%d')
+                iso_date = date_obj.strftime('%Y%m%d')
+            except ValueError:
+                iso_date = 'unknown_date'
+        else:
+            iso_date = 'unknown_date'
+        session_id = f'ses-{iso_date}'
+
+        return (subject_id, session_id), None
+    except Exception as e:
+        return None, e
+
+
+def inspect_dicoms(source_folder, cache=None, staging_folder=None):
     """
     Inspect DICOM files and create a mapping of files to their subject/session organization.
+
+    Headers are parsed by a pool of presort_njobs workers. If a staging folder is given, each DICOM is
+    moved into a staging folder for its subject/session group as soon as its header has been parsed,
+    so files are relocated while the remaining headers are still being parsed.
     
     Args:
         source_folder (str): Path to folder containing DICOM files
+        cache (DicomHeaderCache): Optional header cache. presort_tags are all patient identifiers/dates,
+            which are never cached, so headers are parsed directly without consulting it
+        staging_folder (str): Optional folder where DICOMs are moved to while parsing continues
     
     Returns:
         dict: Nested dictionary of structure:
             {
                 'sub-<patient_id>': {
-                    'ses-<date>': [list_of_dicom_paths]
+                    'ses-<date>': {
+                        'dicoms': [list_of_dicom_paths],
+                        'other': [list_of_non_dicom_paths],
+                        'staged': staging folder of the group (only when staging),
+                        'staged_dicoms': [dicoms moved into the staging folder] (only when staging),
+                        'bytes_copied': bytes copied while staging (only when staging)
+                    }
                 }
             }
     """
-    source_path = Path(source_folder)
     organization = {}
     error_count = 0
     dicom_files = find_dicom_files(source_folder)
-    for dicom_file in dicom_files:
-        try:
-            with nostdout():
-                ds = dcmread(str(dicom_file), stop_before_pixels=True)
-            
-            # Get patient ID (fall back to patient name if ID not available)
-            patient_id = getattr(ds, 'PatientID', None) or getattr(ds, 'PatientName', 'unknown_patient')
-            patient_id = str(patient_id).replace('^', '_')  # Clean up potential special characters
-            subject_id = f'sub-{patient_id}'
-            
-            # Get study date and convert to ISO format
-            study_date = getattr(ds, 'StudyDate', None)
-            if study_date:
-                try:
-                    date_obj = datetime.strptime(study_date, '%Y%m%d')
-                    iso_date = date_obj.strftime('%Y%m%d')
-                except ValueError:
-                    iso_date = 'unknown_date'
-            else:
-                iso_date = 'unknown_date'
-            session_id = f'ses-{iso_date}'
-            
+    staged_groups = 0
+
+    with ThreadPoolExecutor(max_workers=presort_njobs) as executor:
+        # results come back in file order, so the organization doesn't depend on the number of workers
+        results = executor.map(lambda dicom_file: parse_dicom(dicom_file, cache), dicom_files)
+        for dicom_file, (ids, error) in zip(dicom_files, results):
+            if error is not None:
+                print(f"Error inspecting {dicom_file}: {error}")
+                error_count += 1
+                continue
+
             # Build the organization dictionary
+            subject_id, session_id = ids
             if subject_id not in organization:
                 organization[subject_id] = {}
             if session_id not in organization[subject_id]:
                 organization[subject_id][session_id] = {"dicoms": [], "other": []}
-            
-            organization[subject_id][session_id]["dicoms"].append(dicom_file)
-            
-        except Exception as e:
-            print(f"Error inspecting {dicom_file}: {e}")
-            error_count += 1
+            group = organization[subject_id][session_id]
+            group["dicoms"].append(dicom_file)
+
+            if staging_folder is not None:
+                if "staged" not in group:
+                    group["staged"] = Path(staging_folder) / str(staged_groups)
+                    group["staged"].mkdir(parents=True, exist_ok=True)
+                    group["staged_dicoms"] = []
+                    group["bytes_copied"] = 0
+                    staged_groups += 1
+                try:
+                    group["bytes_copied"] += relocate_file(dicom_file, group["staged"] / dicom_file.name)
+                    group["staged_dicoms"].append(dicom_file)
+                except Exception as e:
+                    # left in place, copy_organized_dicoms will try again
+                    print(f"Error staging {dicom_file}: {e}")
     
     # now we collect the folder paths that contain dicoms and associate those
-    # with subject and session id's
+    # with subject and session id's. Membership is checked against a set and each
+    # folder is listed only once, however many subjects/sessions share it.
+    dicom_files_set = set(dicom_files)
+    non_dicoms_per_folder = {}
     for subject_id in organization.keys():
         for session_id in organization[subject_id].keys():
-            # next we get the common paths
-            common_path = os.path.commonpath(organization[subject_id][session_id].get('dicoms'))
-            non_dicoms = [file for file in Path(common_path).iterdir() if file not in dicom_files]
-            for non_dicom in non_dicoms:
-                if non_dicom.is_file():
-                    organization[subject_id][session_id]["other"].append(non_dicom)
+            # next we get the common paths (of the folders, the dicoms may already have been staged)
+            common_path = os.path.commonpath(
+                [dicom.parent for dicom in organization[subject_id][session_id].get('dicoms')]
+            )
+            if common_path not in non_dicoms_per_folder:
+                non_dicoms_per_folder[common_path] = [
+                    file for file in Path(common_path).iterdir()
+                    if file not in dicom_files_set and file.is_file()
+                ]
+            organization[subject_id][session_id]["other"].extend(non_dicoms_per_folder[common_path])
     
     return organization, error_count, dicom_files
 
+def relocate_file(source, destination, keep_source=False):
+    """
+    Relocate a file without copying its data whenever possible: a rename moves it (or, with keep_source,
+    a hardlink duplicates it) when source and destination share a filesystem. Only when that fails
+    (e.g. across devices, or on a filesystem without hardlinks) is the file copied.
+
+    Args:
+        source (Path): File to relocate
+        destination (Path): New path of the file
+        keep_source (bool): Leave the source file in place (duplicate rather than move)
+
+    Returns:
+        int: Number of bytes copied, 0 when the file was renamed or linked
+    """
+    try:
+        if keep_source:
+            os.link(source, destination)
+        else:
+            os.rename(source, destination)
+        return 0
+    except FileExistsError:
+        # unlike shutil.copy2, os.link doesn't replace an existing destination
+        os.unlink(destination)
+        return relocate_file(source, destination, keep_source)
+    except OSError:
+        shutil.copy2(source, destination)
+        if not keep_source:
+            os.unlink(source)
+        return os.path.getsize(destination)
+
+
 def copy_organized_dicoms(organization, output_base):
     """
     Move DICOM files to their organized locations using generic subject/session IDs.
+    Groups that were already staged by inspect_dicoms are relocated by renaming their staging folder,
+    other files are renamed/hardlinked, data is only copied when crossing filesystems.
     
     Args:
         organization (dict): Nested dictionary mapping subjects and sessions to DICOM files
         output_base (str): Base path where organized files will be stored
     
     Returns:
-        tuple: (moved_count, error_count, id_mapping)
+        tuple: (moved_count, error_count, id_mapping, new_session_folders, bytes_copied)
         id_mapping is a dict containing the mapping between original and generic IDs
+        bytes_copied is the amount of data that had to be copied (rather than renamed/linked)
     """
     output_path = Path(output_base)
     output_path.mkdir(parents=True, exist_ok=True)
     
     moved_count = 0
     error_count = 0
+    bytes_copied = 0
     
     # Create mappings for generic IDs
     id_mapping = {
@@ -157,36 +251,63 @@ def copy_organized_dicoms(organization, output_base):
             generic_session = f"ses-{session_numbers[subject_id]:03d}"  # Creates ses-001, ses-002, etc.
             id_mapping['sessions'][(subject_id, session_id)] = generic_session
             session_numbers[subject_id] += 1
+
+    # Create all the directories up front, once per subject/session. Staged groups are renamed into
+    # place, so only their subject directory is needed.
+    session_dirs = {}
+    for subject_id, sessions in organization.items():
+        generic_subject = id_mapping['subjects'][subject_id]
+        for session_id, group in sessions.items():
+            generic_session = id_mapping['sessions'][(subject_id, session_id)]
+            session_dir = output_path / generic_subject / generic_session
+            session_dirs[(subject_id, session_id)] = session_dir
+            if 'staged' in group and not session_dir.exists():
+                session_dir.parent.mkdir(parents=True, exist_ok=True)
+            else:
+                session_dir.mkdir(parents=True, exist_ok=True)
     
     # Now move the files using the generic IDs
     copied_files = []
     new_session_folders = set()
     for subject_id, sessions in organization.items():
-        generic_subject = id_mapping['subjects'][subject_id]
-        for session_id in sessions.keys():
-            generic_session = id_mapping['sessions'][(subject_id, session_id)]
-            # Create session directory with generic IDs
-            session_dir = output_path / generic_subject / generic_session
-            session_dir.mkdir(parents=True, exist_ok=True)
+        for session_id, group in sessions.items():
+            session_dir = session_dirs[(subject_id, session_id)]
             new_session_folders.add(session_dir)
+            bytes_copied += group.get('bytes_copied', 0)
+
+            staged_dicoms = set(group.get('staged_dicoms', []))
+            if 'staged' in group:
+                try:
+                    if session_dir.exists():
+                        for staged_file in group['staged'].iterdir():
+                            bytes_copied += relocate_file(staged_file, session_dir / staged_file.name)
+                        group['staged'].rmdir()
+                    else:
+                        os.rename(group['staged'], session_dir)
+                    moved_count += len(staged_dicoms)
+                except Exception as e:
+                    print(f"Error moving staged DICOMs {group['staged']}: {e}")
+                    error_count += len(staged_dicoms)
+                session_dir.mkdir(parents=True, exist_ok=True)
             
-            
-            # Move DICOM files
-            for dicom_file in organization[subject_id][session_id]['dicoms']:
+            # Move DICOM files (that weren't staged)
+            for dicom_file in group['dicoms']:
+                if dicom_file in staged_dicoms:
+                    continue
                 try:
-                    shutil.move(dicom_file, session_dir / dicom_file.name)
+                    bytes_copied += relocate_file(dicom_file, session_dir / dicom_file.name)
                     moved_count += 1
                 except Exception as e:
                     print(f"Error moving {dicom_file}: {e}")
                     error_count += 1
             
-            # Copy non-dicom files
-            for other in organization[subject_id][session_id]['other']:
+            # Link (or copy) non-dicom files, they can belong to several sessions
+            for other in group['other']:
                 try:
-                    shutil.copy2(other, session_dir / other.name)
+                    bytes_copied += relocate_file(other, session_dir / other.name, keep_source=True)
                     copied_files.append(other)
                 except Exception as e:
-                    print(f"Error reorganizing over non-dicom file {other}")
+                    print(f"Error reorganizing over non-dicom file {other}: {e}")
                     error_count += 1
     
     copied_files = list(set(copied_files))
@@ -194,7 +315,7 @@ def copy_organized_dicoms(organization, output_base):
         print(f"removing source file {copy}")
         copy.unlink()
 
-    return moved_count, error_count, id_mapping, list(new_session_folders)
+    return moved_count, error_count, id_mapping, list(new_session_folders), bytes_copied
 
 
 def parse_args():
@@ -207,7 +328,7 @@ def parse_args():
         args.destination = args.source
     return args
 
-def presort(source_folder, output_base=None):
+def presort(source_folder, output_base=None, cache=None):
 
     if output_base is None:
         output_base = source_folder
@@ -215,8 +336,10 @@ def presort(source_folder, output_base=None):
     #source_folder = folder_path
     #output_base = "/home/anthony/ezbids/OpenNeuroPET-Phantoms/sourcedata/GeneralElectricAdvance-NIMH/organized_dicoms"
     
+    staging_folder = Path(output_base) / staging_folder_name
+
     print(f"\nInspecting DICOM files in {source_folder}")
-    organization, inspect_errors, dicom_files = inspect_dicoms(source_folder)
+    organization, inspect_errors, dicom_files = inspect_dicoms(source_folder, cache, staging_folder)
     from pprint import pprint
     pprint(organization)
     
@@ -224,10 +347,14 @@ def presort(source_folder, output_base=None):
     for subject_id, sessions in organization.items():
         print(f"  {subject_id}:")
         for session_id, files in sessions.items():
-            print(f"    {session_id}: {len(files)} files")
+            print(f"    {session_id}: {len(files['dicoms'])} files")
     
     print(f"\nCopying files to {output_base}")
-    moved, move_errors, id_mapping, new_session_folders = copy_organized_dicoms(organization, output_base)
+    moved, move_errors, id_mapping, new_session_folders, bytes_copied = copy_organized_dicoms(
+        organization, output_base
+    )
+    if staging_folder.exists() and not any(staging_folder.iterdir()):
+        staging_folder.rmdir()
     
     print(f"\nID Mappings:")
     print("Subjects:")
@@ -239,6 +366,7 @@ def presort(source_folder, output_base=None):
     
     print(f"\nOrganization complete:")
     print(f"Successfully moved: {moved} DICOM files")
+    print(f"Bytes copied (rather than renamed/linked): {bytes_copied}")
     print(f"Errors during inspection: {inspect_errors}")
     print(f"Errors during moving: {move_errors}")
 
@@ -248,4 +376,7 @@ if __name__ == "__main__":
     args = parse_args()
     source_folder = args.source
     output_base = args.destination
-    presort(source_folder, output_base)
\ No newline at end of file
+    header_cache = open_cache()
+    presort(source_folder, output_base, header_cache)
+    if header_cache is not None:
+        header_cache.close()
\ No newline at end of file
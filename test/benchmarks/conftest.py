@@ -0,0 +1,49 @@
+import gc
+import time
+
+import pytest
+
+
+@pytest.fixture
+def best_time():
+    """
+    Times function(*make_args()) repeat times and returns the best wall-clock time. The arguments are
+    rebuilt, untimed, before every run since most of the timed functions modify them. The garbage collector
+    is disabled while timing, like timeit does, as its passes over the arguments grow with their size.
+    """
+
+    def measure(function, make_args, repeat=5):
+        times = []
+        for _ in range(repeat):
+            args = make_args()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                function(*args)
+                times.append(time.perf_counter() - start)
+            finally:
+                gc.enable()
+        return min(times)
+
+    return measure
+
+
+@pytest.fixture
+def assert_linear(best_time):
+    """
+    Times function at a small and a large input size and fails if the time per item grew by more than
+    max_growth (a linear function stays around 1, a quadratic one grows by large / small).
+    """
+
+    def check(function, make_args, small, large, max_growth=2, repeat=5):
+        small_time = best_time(function, lambda: make_args(small), repeat)
+        large_time = best_time(function, lambda: make_args(large), repeat)
+        growth = (large_time / large) / (small_time / small)
+        print(
+            f"{function.__name__}: {small} items {small_time * 1000:.1f} ms, "
+            f"{large} items {large_time * 1000:.1f} ms, time per item x{growth:.2f}"
+        )
+        assert growth < max_growth
+        return small_time, large_time
+
+    return check
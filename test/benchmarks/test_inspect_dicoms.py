@@ -0,0 +1,67 @@
+"""
+inspect_dicoms on a flat folder: every subject/session group shares the folder, listing the files
+that aren't DICOMs must stay linear in the number of files (it used to scan the list of DICOMs for
+every file of every group).
+"""
+
+import shutil
+
+import pytest
+
+pytestmark = pytest.mark.benchmark
+
+n_patients = 10
+n_dates = 2
+n_other_files = 10
+
+
+@pytest.fixture(scope="module")
+def flat_folders(tmp_path_factory, write_dicom):
+    folders = {}
+
+    def make(n):
+        if n not in folders:
+            folder = tmp_path_factory.mktemp(f"flat_{n}")
+            for i in range(n):
+                write_dicom(
+                    folder / f"{i:06d}.dcm",
+                    PatientID=f"P{i % n_patients}",
+                    PatientName=f"N{i % n_patients}",
+                    StudyDate=f"2024010{1 + (i // n_patients) % n_dates}",
+                )
+            for i in range(n_other_files):
+                (folder / f"notes_{i}.txt").write_text("not a dicom")
+            folders[n] = folder
+        return folders[n]
+
+    return make
+
+
+def test_inspect_dicoms_is_linear(assert_linear, flat_folders):
+    from presort_dicoms import inspect_dicoms
+
+    assert_linear(
+        inspect_dicoms,
+        lambda n: (str(flat_folders(n)),),
+        small=500,
+        large=2000,
+        repeat=3,
+    )
+
+
+def test_inspect_dicoms_lists_other_files_once_per_group(flat_folders, tmp_path):
+    from presort_dicoms import inspect_dicoms
+
+    folder = tmp_path / "flat"
+    shutil.copytree(flat_folders(500), folder)
+
+    organization, error_count, dicom_files = inspect_dicoms(str(folder))
+
+    assert error_count == 0
+    assert len(dicom_files) == 500
+    groups = [x for sessions in organization.values() for x in sessions.values()]
+    assert len(groups) == n_patients * n_dates
+    for group in groups:
+        assert sorted(x.name for x in group["other"]) == sorted(
+            f"notes_{i}.txt" for i in range(n_other_files)
+        )
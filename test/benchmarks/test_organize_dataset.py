@@ -0,0 +1,60 @@
+"""
+organize_dataset assigns pseudo subjects to anonymized acquisitions, it must stay close to linear (it
+used to sort the upload again after every acquisition).
+"""
+
+import random
+from operator import itemgetter
+
+import pytest
+from scripts import load_analyzer
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="module")
+def organize_dataset():
+    return load_analyzer("organize_dataset", itemgetter=itemgetter)["organize_dataset"]
+
+
+def make_acquisition(subject, series_number, acquisition_time, anonymized):
+    return {
+        "subject": "n/a" if anonymized else f"s{subject:04d}",
+        "AcquisitionDateTime": (
+            "0000-00-00T00:00:00.000000" if anonymized else "2024-01-01T00:00:00.000000"
+        ),
+        "PatientID": "n/a" if anonymized else f"P{subject}",
+        "PatientName": "n/a" if anonymized else f"N{subject}",
+        "SeriesNumber": series_number,
+        "ModifiedSeriesNumber": f"{series_number:02d}",
+        "AcquisitionTime": acquisition_time,
+    }
+
+
+def make_upload(n):
+    """
+    n acquisitions of subjects with 1-2 sessions of 3-15 series each, about 80% of them anonymized.
+    """
+    rng = random.Random(n)
+    dataset_list = []
+    subject = 0
+    while len(dataset_list) < n:
+        subject += 1
+        anonymized = rng.random() < 0.8
+        for session in range(rng.randint(1, 2)):
+            for series_number in range(1, rng.randint(3, 15) + 1):
+                hour = 9 + session + rng.randint(0, 3)
+                dataset_list.append(
+                    make_acquisition(
+                        subject,
+                        series_number,
+                        f"{hour:02d}:{series_number:02d}:00.000000",
+                        anonymized,
+                    )
+                )
+    rng.shuffle(dataset_list)
+    return (dataset_list[:n],)
+
+
+def test_organize_dataset_is_linear(assert_linear, organize_dataset):
+    assert_linear(organize_dataset, make_upload, small=10000, large=40000)
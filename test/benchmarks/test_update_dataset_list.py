@@ -0,0 +1,53 @@
+"""
+update_dataset_list copies the attributes of every unique series onto its acquisitions, it must stay
+linear in the number of acquisitions (it used to scan every acquisition for each unique series).
+"""
+
+import random
+
+import pytest
+from scripts import load_analyzer
+
+pytestmark = pytest.mark.benchmark
+
+
+def make_dataset(n):
+    rng = random.Random(n)
+    # one unique series for every 30 acquisitions, as in a large multi-subject upload
+    n_unique = max(1, n // 30)
+    dataset_list_unique_series = [
+        {
+            "series_idx": i,
+            "entities": {"run": str(i)},
+            "type": "func/bold",
+            "error": None,
+            "message": f"series {i}",
+            "IntendedFor": None,
+            "B0FieldIdentifier": None,
+            "B0FieldSource": None,
+        }
+        for i in range(n_unique)
+    ]
+    # a few acquisitions refer to series that were excluded from the unique series
+    dataset_list = [{"series_idx": rng.randrange(n_unique + 5)} for _ in range(n)]
+    return dataset_list, dataset_list_unique_series
+
+
+def test_update_dataset_list_is_linear(assert_linear):
+    update_dataset_list = load_analyzer("update_dataset_list")["update_dataset_list"]
+
+    assert_linear(update_dataset_list, make_dataset, small=5000, large=20000)
+
+
+def test_update_dataset_list_propagates_series_attributes():
+    update_dataset_list = load_analyzer("update_dataset_list")["update_dataset_list"]
+    dataset_list, dataset_list_unique_series = make_dataset(300)
+    unique_series = {x["series_idx"]: x for x in dataset_list_unique_series}
+
+    update_dataset_list(dataset_list, dataset_list_unique_series)
+
+    for data in dataset_list:
+        if data["series_idx"] in unique_series:
+            assert data["message"] == unique_series[data["series_idx"]]["message"]
+        else:
+            assert "message" not in data
@@ -0,0 +1,38 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The handler scripts aren't installed as a package, make them (and the analyzer's
+# modules) importable
+handler_dir = Path(__file__).resolve().parents[1] / "handler"
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(str(handler_dir))
+sys.path.append(str(handler_dir / "ezBIDS_core"))
+
+
+@pytest.fixture(scope="session")
+def write_dicom():
+    """
+    Writes a minimal (header only) DICOM file with the given tags.
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    def write(path, **tags):
+        meta = FileMetaDataset()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds = Dataset()
+        ds.file_meta = meta
+        for tag, value in tags.items():
+            setattr(ds, tag, value)
+        try:
+            ds.save_as(path, enforce_file_format=True)
+        except TypeError:  # pydicom < 3, as installed in the handler image
+            ds.save_as(path, write_like_original=False)
+        return path
+
+    return write
@@ -0,0 +1,76 @@
+"""
+Access to the functions of the handler scripts (ezBIDS_core.py, find_img_data.py) from
+tests.
+
+The scripts run as soon as they are imported (e.g. ezBIDS_core.py runs the whole
+analyzer on sys.argv[1]). Tests instead execute only the definitions they need (and the
+imports those use), with the module-level globals they read passed in explicitly.
+"""
+
+import ast
+from pathlib import Path
+
+handler_dir = Path(__file__).resolve().parents[1] / "handler"
+
+
+def referenced_names(nodes):
+    names = set()
+    for node in nodes:
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name):
+                names.add(child.id)
+    return names
+
+
+def load_script(script, *names, **namespace):
+    """
+    Executes the top-level functions and classes called names from a handler script.
+
+    Parameters
+    ----------
+    script : string
+        path of the script, relative to handler/
+
+    names : strings
+        functions and classes to define
+
+    namespace : keyword arguments
+        module-level globals the definitions use (e.g. classification_memo)
+
+    Returns
+    -------
+    namespace : dictionary
+        module globals, holding the definitions
+    """
+    path = handler_dir / script
+    tree = ast.parse(path.read_text(), str(path))
+    definitions = [
+        node
+        for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names
+    ]
+    missing = set(names) - {node.name for node in definitions}
+    if missing:
+        raise NameError(f"not defined in {script}: {sorted(missing)}")
+
+    used = referenced_names(definitions)
+    imports = []
+    for node in tree.body:
+        if isinstance(node, ast.Import) or (
+            isinstance(node, ast.ImportFrom) and node.module != "__future__"
+        ):
+            bound = {(x.asname or x.name).split(".")[0] for x in node.names}
+            if bound & used:
+                imports.append(node)
+
+    module = ast.Module(body=imports + definitions, type_ignores=[])
+    namespace = dict(namespace, __name__=path.stem)
+    exec(compile(module, str(path), "exec"), namespace)
+    return namespace
+
+
+def load_analyzer(*names, **namespace):
+    """
+    Same as load_script, for ezBIDS_core.py.
+    """
+    return load_script("ezBIDS_core/ezBIDS_core.py", *names, **namespace)
@@ -0,0 +1,102 @@
+import json
+import pickle
+
+import bids_schema
+import pytest
+
+
+@pytest.fixture
+def schema_dir(tmp_path):
+    schema_dir = tmp_path / "schema"
+    files = {
+        "objects/datatypes.yaml": "anat:\n  value: anat\n",
+        "objects/entities.yaml": "subject:\n  name: sub\n",
+        "objects/suffixes.yaml": "T1w:\n  value: T1w\n",
+        "rules/dataset_metadata.yaml": "dataset_description: {}\n",
+        "rules/entities.yaml": "- subject\n",
+        "rules/datatypes/anat.yaml": "nonparametric:\n  suffixes: [T1w]\n",
+    }
+    for file, content in files.items():
+        (schema_dir / file).parent.mkdir(parents=True, exist_ok=True)
+        (schema_dir / file).write_text(content)
+    return schema_dir
+
+
+@pytest.fixture
+def cache_path(tmp_path, monkeypatch):
+    cache_path = tmp_path / "cache" / "bids_schema.json"
+    monkeypatch.setattr(bids_schema, "cache_path", str(cache_path))
+    return cache_path
+
+
+@pytest.fixture
+def load(monkeypatch):
+    """
+    load_schema as in a new analyzer session, returns the schema and whether it was compiled.
+    """
+    compile_schema = bids_schema.compile_schema
+
+    def load(schema_dir):
+        compiled = []
+
+        def compile(*args):
+            compiled.append(args)
+            return compile_schema(*args)
+
+        monkeypatch.setattr(bids_schema, "_schema", None)
+        monkeypatch.setattr(bids_schema, "compile_schema", compile)
+        return bids_schema.load_schema(str(schema_dir)), bool(compiled)
+
+    return load
+
+
+def test_second_session_loads_the_cache(schema_dir, cache_path, load):
+    schema, compiled = load(schema_dir)
+    cached_schema, cached_compiled = load(schema_dir)
+
+    assert (compiled, cached_compiled) == (True, False)
+    assert cached_schema == schema
+    assert schema["datatype_rules"]["anat"]["nonparametric"]["suffixes"] == ["T1w"]
+    assert json.loads(cache_path.read_text())["key"] == bids_schema.loaded_schema_hash()
+
+
+def test_changed_schema_file_is_recompiled(schema_dir, cache_path, load):
+    load(schema_dir)
+    (schema_dir / "objects/suffixes.yaml").write_text("T2w:\n  value: T2w\n")
+
+    schema, compiled = load(schema_dir)
+
+    assert compiled
+    assert list(schema["suffixes"]) == ["T2w"]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"{not json",
+        b'["a", "list"]',
+        pickle.dumps({"key": "x", "schema": {}}),
+    ],
+    ids=["truncated", "not an object", "pickle"],
+)
+def test_unreadable_cache_is_rebuilt(schema_dir, cache_path, load, content):
+    cache_path.parent.mkdir()
+    cache_path.write_bytes(content)
+
+    schema, compiled = load(schema_dir)
+
+    assert compiled
+    assert json.loads(cache_path.read_text())["schema"] == schema
+
+
+def test_unwritable_cache_is_skipped(schema_dir, tmp_path, monkeypatch, load, capsys):
+    (tmp_path / "file").write_text("")
+    monkeypatch.setattr(
+        bids_schema, "cache_path", str(tmp_path / "file" / "cache.json")
+    )
+
+    schema, compiled = load(schema_dir)
+
+    assert compiled
+    assert list(schema["suffixes"]) == ["T1w"]
+    assert "Unable to write BIDS schema cache" in capsys.readouterr().out
@@ -0,0 +1,110 @@
+import sqlite3
+
+import classification_cache
+import pytest
+from cache_store import LRUStore
+from classification_cache import ClassificationCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache" / "classification.sqlite")
+
+
+@pytest.fixture
+def session(path):
+    """
+    Opens the cache as an analyzer session would, closing every session opened by the test.
+    """
+    caches = []
+
+    def open_session(namespace="schema-1", max_bytes=1024 * 1024):
+        caches.append(ClassificationCache(namespace, path, max_bytes))
+        return caches[-1]
+
+    yield open_session
+    for cache in caches:
+        cache.close()
+
+
+@pytest.fixture
+def write_locked(path):
+    """
+    Another session holding the write lock of the database.
+    """
+    LRUStore(path, 1024).close()
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    yield other
+    other.execute("ROLLBACK")
+    other.close()
+
+
+def test_miss_then_hit_across_sessions(session):
+    cache = session()
+    assert cache.get("entities", "sig") is None
+
+    cache.put("entities", "sig", {"run": "1", "echo": ""})
+    cache.close()
+
+    assert session().get("entities", "sig") == {"run": "1", "echo": ""}
+
+
+def test_new_namespace_invalidates_entries(session):
+    session("schema-1").put("entities", "sig", {"run": "1"})
+
+    assert session("schema-2").get("entities", "sig") is None
+    assert session("schema-1").get("entities", "sig") == {"run": "1"}
+
+
+def test_stages_are_cached_separately(session):
+    cache = session()
+    cache.put("entities", "sig", {"run": "1"})
+
+    assert cache.get("datatype_suffix", "sig") is None
+
+
+def test_least_recently_used_entries_are_evicted(session):
+    cache = session(max_bytes=400)
+    for i in range(8):
+        cache.put("entities", f"sig{i}", {"acq": "x" * 20})
+    # reading sig0 makes it the most recently used
+    assert cache.get("entities", "sig0") is not None
+    cache.close()
+
+    cache = session(max_bytes=400)
+    kept = [i for i in range(8) if cache.get("entities", f"sig{i}") is not None]
+
+    assert 0 in kept
+    assert 1 not in kept
+    assert len(kept) < 8
+
+
+def test_locked_database_disables_the_cache(session, write_locked, capsys):
+    cache = session()
+    cache.store.connection.execute("PRAGMA busy_timeout = 50")
+
+    cache.put("entities", "sig", {"run": "1"})
+
+    assert not cache.store.enabled
+    assert "disabled for this session" in capsys.readouterr().out
+    # every lookup misses from now on, the analyzer classifies the series itself
+    assert cache.get("entities", "sig") is None
+    cache.put("entities", "sig", {"run": "1"})
+
+
+def test_writes_are_committed_right_away(session, path):
+    cache = session()
+    cache.put("entities", "sig", {"run": "1"})
+
+    # a second session can take the write lock while the first one is still open
+    other = sqlite3.connect(path, isolation_level=None, timeout=0)
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("ROLLBACK")
+    other.close()
+
+
+def test_open_cache_is_disabled_by_an_empty_path(monkeypatch):
+    monkeypatch.setattr(classification_cache, "cache_path", "")
+
+    assert classification_cache.open_cache("schema-1") is None
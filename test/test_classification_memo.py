@@ -0,0 +1,160 @@
+"""
+The classification memo (and the persistent cache behind it) replays results by protocol
+signature, so a signature must capture everything the classification reads.
+"""
+
+import copy
+import random
+
+import pytest
+from scripts import load_analyzer
+from cog_atlas import TaskMatcher
+
+# entity name -> BIDS key, in the order of the specification (rules/entities.yaml)
+entities = {
+    "subject": "sub",
+    "session": "ses",
+    "task": "task",
+    "acquisition": "acq",
+    "ceagent": "ce",
+    "tracer": "trc",
+    "reconstruction": "rec",
+    "direction": "dir",
+    "run": "run",
+    "echo": "echo",
+    "flip": "flip",
+    "inversion": "inv",
+    "mtransfer": "mt",
+    "part": "part",
+}
+
+types = [
+    ("anat", "MP2RAGE"),
+    ("anat", "IRT1"),
+    ("anat", "T1w"),
+    ("func", "bold"),
+    ("fmap", "RB1COR"),
+]
+
+series_descriptions = [
+    "mp2rage_inv1",
+    "IR_inv2_flip2",
+    "tfMRI_stroop_run1",
+    "T1_MPRAGE",
+]
+
+
+@pytest.fixture
+def analyzer():
+    namespace = load_analyzer(
+        "protocol_path",
+        "entity_signature",
+        "datatype_suffix_signature",
+        "ClassificationMemo",
+        "entity_labels_identification",
+        entities_yaml={key: {"entity": entity} for key, entity in entities.items()},
+        entity_ordering=list(entities),
+        cog_atlas_task_matcher=TaskMatcher(["stroop", "nback"]),
+    )
+    namespace["classification_memo"] = namespace["ClassificationMemo"]()
+    return namespace
+
+
+@pytest.fixture
+def lookup_dic():
+    lookup_dic = {}
+    for datatype, suffix in types:
+        lookup_dic.setdefault(datatype, {})[suffix] = {
+            "accepted_entities": list(entities)
+        }
+    return lookup_dic
+
+
+def make_series(rng, subject):
+    datatype, suffix = rng.choice(types)
+    sd = rng.choice(series_descriptions)
+    sidecar = {"Manufacturer": "Siemens"}
+    for key, value in [("InversionTime", 0.9), ("FlipAngle", 4), ("DelayTime", 0.1)]:
+        if rng.random() < 0.5:
+            sidecar[key] = value
+    coil = rng.choice([None, "Body"])
+    if coil is not None:
+        sidecar["ReceiveCoilName"] = coil
+    return {
+        "finalized_match": False,
+        "descriptor": "SeriesDescription",
+        "SeriesDescription": sd,
+        "json_path": f"./upload/sub-{subject}/ses-1/{sd}.json",
+        "type": f"{datatype}/{suffix}",
+        "datatype": datatype,
+        "suffix": suffix,
+        "direction": rng.choice(["AP", "PA"]),
+        "EchoNumber": rng.choice([None, 1]),
+        "ImageType": rng.choice(
+            [["ORIGINAL", "PRIMARY", "M"], ["ORIGINAL", "PRIMARY", "P", "PHASE"]]
+        ),
+        "sidecar": sidecar,
+    }
+
+
+def label(analyzer, dataset_list_unique_series, lookup_dic):
+    series = copy.deepcopy(dataset_list_unique_series)
+    analyzer["entity_labels_identification"](series, lookup_dic)
+    return [x["entities"] for x in series]
+
+
+def test_memoized_entity_labels_match_unmemoized(analyzer, lookup_dic):
+    rng = random.Random(0)
+    # few distinct protocols, so that most are repeated and served by the memo
+    series = [make_series(rng, subject=rng.randint(1, 3)) for _ in range(3000)]
+
+    memoized = label(analyzer, series, lookup_dic)
+    assert analyzer["classification_memo"].hits > 0
+
+    analyzer["entity_signature"] = lambda unique_dic: None
+    unmemoized = label(analyzer, series, lookup_dic)
+
+    assert memoized == unmemoized
+
+
+def test_inversion_time_is_part_of_the_entity_signature(analyzer, lookup_dic):
+    rng = random.Random(0)
+    with_inversion_time = make_series(rng, subject=1)
+    with_inversion_time.update(
+        type="anat/MP2RAGE",
+        datatype="anat",
+        suffix="MP2RAGE",
+        SeriesDescription="mp2rage_inv1",
+        json_path="./upload/sub-1/ses-1/mp2rage_inv1.json",
+    )
+    with_inversion_time["sidecar"]["InversionTime"] = 0.9
+    without_inversion_time = copy.deepcopy(with_inversion_time)
+    del without_inversion_time["sidecar"]["InversionTime"]
+
+    labels = label(analyzer, [with_inversion_time, without_inversion_time], lookup_dic)
+
+    assert labels[0]["inversion"] == "1"
+    assert labels[1]["inversion"] == ""
+
+
+def test_datatype_suffix_signature_tells_short_lists_from_missing_e1_ph(analyzer):
+    rng = random.Random(0)
+    series = make_series(rng, subject=1)
+    series.update(
+        paths=["./upload/sub-1/ses-1/gre_field_mapping_e2_ph.nii.gz"],
+        EchoTime=7.38,
+        RepetitionTime=0.5,
+        ndim=3,
+        NumVolumes=1,
+        Modality="MR",
+        message="",
+        error="",
+    )
+    signature = analyzer["datatype_suffix_signature"]
+
+    # 2 series: the phasediff and phase2 conditions both fail
+    short = signature(series, [series, series], 1)
+    # 3 series, no _e1_ph two before: the phasediff condition passes
+    without_e1_ph = signature(series, [series, series, series], 2)
+
+    assert short != without_e1_ph
@@ -0,0 +1,71 @@
+import json
+from datetime import datetime, timezone
+
+import cog_atlas
+import pytest
+
+
+def vocabulary(retrieved, names):
+    return {"source": cog_atlas.cog_atlas_url, "retrieved": retrieved, "names": names}
+
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    snapshot = tmp_path / "tasks.json"
+    cache = tmp_path / "cache.json"
+    monkeypatch.setattr(cog_atlas, "snapshot_path", str(snapshot))
+    monkeypatch.setattr(cog_atlas, "cache_path", str(cache))
+    monkeypatch.setattr(cog_atlas, "refresh_enabled", False)
+    return snapshot, cache
+
+
+def test_committed_snapshot_is_well_formed():
+    with open(cog_atlas.snapshot_path) as f:
+        snapshot = json.load(f)
+
+    assert isinstance(snapshot["version"], int)
+    # a real download lists hundreds of tasks
+    assert len(snapshot["names"]) > 100
+    assert all(isinstance(x, str) and x for x in snapshot["names"])
+    # the most recent copy wins, a future date would shadow every refreshed cache
+    assert datetime.fromisoformat(snapshot["retrieved"]) <= datetime.now(timezone.utc)
+
+
+def test_most_recent_copy_wins(paths):
+    snapshot, cache = paths
+    cog_atlas.write_snapshot(
+        vocabulary("2026-01-01T00:00:00+00:00", ["stroop task"]), snapshot
+    )
+    cog_atlas.write_vocabulary(
+        vocabulary("2026-06-01T00:00:00+00:00", ["n-back"]), cache
+    )
+
+    assert cog_atlas.load_cog_atlas_tasks() == ["nback"]
+
+    cog_atlas.write_snapshot(
+        vocabulary("2026-09-01T00:00:00+00:00", ["stroop task"]), snapshot
+    )
+
+    assert cog_atlas.load_cog_atlas_tasks() == ["stroop"]
+    assert json.loads(snapshot.read_text())["version"] == 2
+
+
+def test_write_snapshot_resolves_its_path_when_called(paths):
+    snapshot, _ = paths
+
+    cog_atlas.write_snapshot(vocabulary("2026-01-01T00:00:00+00:00", ["stroop task"]))
+
+    assert json.loads(snapshot.read_text())["names"] == ["stroop task"]
+
+
+def test_empty_snapshot_is_ignored(paths):
+    snapshot, cache = paths
+    snapshot.write_text(json.dumps(dict(version=0, **vocabulary("", []))))
+
+    assert cog_atlas.load_cog_atlas_tasks() == []
+
+    cog_atlas.write_vocabulary(
+        vocabulary("2026-06-01T00:00:00+00:00", ["n-back"]), cache
+    )
+
+    assert cog_atlas.load_cog_atlas_tasks() == ["nback"]
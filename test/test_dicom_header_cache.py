@@ -0,0 +1,142 @@
+import json
+import os
+import sqlite3
+
+import dicom_header_cache
+import pytest
+from dicom_header_cache import DicomHeaderCache, read_header, read_header_tags
+
+tags = ["Modality", "SeriesDescription"]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DicomHeaderCache(str(tmp_path / "cache" / "headers.sqlite"), 1024 * 1024)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def dicom(tmp_path, write_dicom):
+    return str(
+        write_dicom(
+            tmp_path / "a.dcm",
+            Modality="MR",
+            SeriesDescription="T1w_MPR",
+            PatientID="P0042",
+            PatientName="Doe^Jane",
+        )
+    )
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """
+    Files whose header was parsed (rather than served by the cache).
+    """
+    files = []
+
+    def read(file_path, tags):
+        files.append(file_path)
+        return read_header_tags(file_path, tags)
+
+    monkeypatch.setattr(dicom_header_cache, "read_header_tags", read)
+    return files
+
+
+def stored_values(cache):
+    with sqlite3.connect(cache.store.path) as connection:
+        return [json.loads(x) for x, in connection.execute("SELECT value FROM entries")]
+
+
+def test_miss_then_hit(cache, dicom, parsed):
+    header, bytes_read = cache.read(dicom, tags)
+    cached_header, cached_bytes_read = cache.read(dicom, tags)
+
+    assert header == cached_header == {"Modality": "MR", "SeriesDescription": "T1w_MPR"}
+    assert parsed == [dicom]
+    assert (cache.hits, cache.misses) == (1, 1)
+    # the key is a hash of the head of the file, those bytes count on hits and misses
+    assert cached_bytes_read == os.path.getsize(dicom)
+    assert bytes_read > cached_bytes_read
+
+
+def test_non_dicom_is_cached(cache, tmp_path, parsed):
+    path = tmp_path / "notes.txt"
+    path.write_text("not a dicom")
+
+    assert cache.read(str(path), tags)[0] is None
+    assert cache.read(str(path), tags)[0] is None
+    assert parsed == [str(path)]
+
+
+def test_modified_file_is_a_miss(cache, dicom, write_dicom, parsed):
+    cache.read(dicom, tags)
+    write_dicom(dicom, Modality="PT", SeriesDescription="FDG")
+    os.utime(dicom, ns=(0, os.stat(dicom).st_mtime_ns + 1))
+
+    header, _ = cache.read(dicom, tags)
+
+    assert header == {"Modality": "PT", "SeriesDescription": "FDG"}
+    assert parsed == [dicom, dicom]
+
+
+def test_patient_identifiers_are_never_stored(cache, dicom, parsed):
+    for _ in range(2):
+        header, _ = cache.read(dicom, ["Modality", "PatientID", "PatientName"])
+        assert header == {
+            "Modality": "MR",
+            "PatientID": "P0042",
+            "PatientName": "Doe^Jane",
+        }
+
+    assert parsed == [dicom, dicom]
+    assert cache.hits == 0
+    assert stored_values(cache) == [{"Modality": "MR"}]
+
+
+def test_identifying_only_requests_bypass_the_cache(cache, dicom, parsed):
+    # presort only asks for these, a lookup would always miss
+    tags = ["PatientID", "PatientName", "StudyDate"]
+
+    header, _ = read_header(dicom, tags, cache)
+
+    assert header == {
+        "PatientID": "P0042",
+        "PatientName": "Doe^Jane",
+        "StudyDate": None,
+    }
+    assert parsed == [dicom]
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert stored_values(cache) == []
+
+
+def test_headers_without_cacheable_tags_are_not_stored(cache, dicom):
+    cache.read(dicom, ["PatientID", "SeriesDate"])
+
+    assert stored_values(cache) == []
+
+
+def test_locked_database_falls_back_to_parsing(cache, dicom, parsed, capsys):
+    cache.store.connection.execute("PRAGMA busy_timeout = 50")
+    # another session holding the write lock
+    other = sqlite3.connect(cache.store.path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        header, _ = cache.read(dicom, tags)
+        assert header == {"Modality": "MR", "SeriesDescription": "T1w_MPR"}
+        assert not cache.store.enabled
+        assert "disabled for this session" in capsys.readouterr().out
+
+        # the session carries on without the cache
+        assert cache.read(dicom, tags)[0] == header
+        assert parsed == [dicom, dicom]
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+
+def test_open_cache_is_disabled_by_an_empty_path(monkeypatch):
+    monkeypatch.setattr(dicom_header_cache, "cache_path", "")
+
+    assert dicom_header_cache.open_cache() is None
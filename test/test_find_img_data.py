@@ -0,0 +1,84 @@
+import pytest
+from dicom_header_cache import read_header
+from scripts import load_script
+
+modality_probe_files = 8
+
+
+def classifier(pet2bids_installed):
+    return load_script(
+        "find_img_data.py",
+        "classify_directory",
+        dicom_extensions=(".dcm", ".ima", ".img", ""),
+        dicom_tags=["Modality"],
+        modality_probe_files=modality_probe_files,
+        read_header=read_header,
+        header_cache=None,
+        pet2bidsInstalled=pet2bids_installed,
+    )["classify_directory"]
+
+
+def files_read(log_lines):
+    return sum(x.startswith("Trying to read DICOM file") for x in log_lines)
+
+
+@pytest.fixture
+def make_dir(tmp_path, write_dicom):
+    def make(**counts):
+        # files are named after their modality, so each modality is contiguous once sorted
+        for modality, count in counts.items():
+            for i in range(count):
+                write_dicom(tmp_path / f"{modality}{i:03d}.dcm", Modality=modality)
+        (tmp_path / "notes.txt").write_text("not a dicom")
+        return str(tmp_path), sorted(x.name for x in tmp_path.iterdir())
+
+    return make
+
+
+def test_pet_mr_directory_has_both_modalities(make_dir):
+    # the PET files sort after all of the MR ones
+    root, files = make_dir(MR=40, PT=10)
+
+    modalities, bytes_read, log_lines = classifier(True)(root, files)
+
+    assert modalities == {"MR", "PT"}
+    assert files_read(log_lines) <= 1 + modality_probe_files
+    assert bytes_read > 0
+
+
+def test_mr_directory_reads_a_fixed_number_of_files(make_dir):
+    root, files = make_dir(MR=50)
+
+    modalities, _, log_lines = classifier(True)(root, files)
+
+    assert modalities == {"MR"}
+    assert files_read(log_lines) == 1 + modality_probe_files
+
+
+def test_pet_directory_reads_a_fixed_number_of_files(make_dir):
+    root, files = make_dir(PT=50)
+
+    modalities, _, log_lines = classifier(True)(root, files)
+
+    assert modalities == {"PT"}
+    assert files_read(log_lines) == 1 + modality_probe_files
+
+
+def test_mr_stops_the_scan_without_pet2bids(make_dir):
+    root, files = make_dir(MR=3, PT=2)
+
+    modalities, _, log_lines = classifier(False)(root, files)
+
+    # PET would be converted by dcm2niix along with the MR data anyway
+    assert modalities == {"MR"}
+    assert files_read(log_lines) == 1
+
+
+def test_other_modalities(make_dir):
+    root, files = make_dir(CT=2)
+
+    modalities, _, log_lines = classifier(True)(root, files)
+
+    # no MR or PET file, every candidate is read (files without an extension are candidates)
+    assert modalities == {"other"}
+    assert files_read(log_lines) == 3
@@ -0,0 +1,68 @@
+"""
+group_acquisitions replaced the linear filters determine_sub_ses_IDs and modify_objects_info ran once per
+subject (and session), it must give them the same acquisitions, in the same order.
+"""
+
+import random
+
+import numpy as np
+import pytest
+from scripts import load_analyzer
+
+
+@pytest.fixture(scope="module")
+def group_acquisitions():
+    return load_analyzer("group_acquisitions")["group_acquisitions"]
+
+
+def make_dataset(rng):
+    return [
+        {
+            "subject": rng.choice(["01", "02", "10", "n/a0001", "n/a0002"]),
+            "subject_idx": rng.randint(0, 4),
+            "session_idx": rng.randint(0, 2),
+        }
+        for _ in range(rng.randint(0, 200))
+    ]
+
+
+def ids(acquisitions):
+    return [id(x) for x in acquisitions]
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_subject_groups_match_previous_filters(group_acquisitions, seed):
+    dataset_list = make_dataset(random.Random(seed))
+
+    subject_groups = group_acquisitions(dataset_list, ["subject"])
+
+    # determine_sub_ses_IDs, before the grouping
+    subjects = np.unique([x["subject"] for x in dataset_list])
+    assert sorted(subject_groups) == sorted(subjects)
+    for sub in subjects:
+        assert ids(subject_groups[sub]) == ids(
+            [x for x in dataset_list if x["subject"] == sub]
+        )
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_subject_session_groups_match_previous_filters(group_acquisitions, seed):
+    dataset_list = make_dataset(random.Random(seed))
+
+    subj_ses_groups = group_acquisitions(dataset_list, ["subject_idx", "session_idx"])
+
+    # modify_objects_info, before the grouping
+    subj_ses_pairs = [[x["subject_idx"], x["session_idx"]] for x in dataset_list]
+    unique_subj_ses_pairs = sorted(
+        [list(i) for i in set(tuple(i) for i in subj_ses_pairs)]
+    )
+    assert [list(x) for x in sorted(subj_ses_groups)] == unique_subj_ses_pairs
+    for unique_subj_ses in unique_subj_ses_pairs:
+        assert ids(subj_ses_groups[tuple(unique_subj_ses)]) == ids(
+            [
+                x
+                for x in dataset_list
+                if x["subject_idx"] == unique_subj_ses[0]
+                and x["session_idx"] == unique_subj_ses[1]
+            ]
+        )
@@ -0,0 +1,137 @@
+"""
+organize_dataset keeps an index of the acquisitions' order instead of sorting them again after every
+pseudo subject ID it assigns, it must assign the same pseudo subjects (and return the same order) as the
+repeated sorts it replaced.
+"""
+
+import copy
+import random
+from operator import itemgetter
+
+import pytest
+from scripts import load_analyzer
+
+
+def previous_organize_dataset(dataset_list):
+    """
+    organize_dataset before the order index, sorting the list once per acquisition.
+    """
+    dataset_list = sorted(
+        dataset_list,
+        key=itemgetter("subject", "AcquisitionTime", "ModifiedSeriesNumber"),
+    )
+
+    pseudo_sub = 1
+    for index, unique_dic in enumerate(dataset_list):
+        if unique_dic["subject"] == "n/a":
+            if (
+                unique_dic["AcquisitionDateTime"] == "0000-00-00T00:00:00.000000"
+                and unique_dic["PatientID"] == "n/a"
+                and unique_dic["PatientName"] == "n/a"
+            ):
+                if index == 0:
+                    subj = pseudo_sub
+                else:
+                    previous_data = dataset_list[index - 1]
+                    if unique_dic["SeriesNumber"] >= previous_data["SeriesNumber"]:
+                        if (
+                            not unique_dic["SeriesNumber"]
+                            - previous_data["SeriesNumber"]
+                            < 2
+                        ):
+                            subj = pseudo_sub - 1
+                        else:
+                            subj = pseudo_sub
+                    else:
+                        if int(unique_dic["SeriesNumber"]) == 1:
+                            pseudo_sub += 1
+                        subj = pseudo_sub
+
+                unique_dic["subject"] = (
+                    unique_dic["subject"] + ("0" * (4 - len(str(subj)))) + str(subj)
+                )
+                unique_dic["AcquisitionDateTime"] = unique_dic["subject"][:-4]
+
+        dataset_list = sorted(
+            dataset_list,
+            key=itemgetter("subject", "AcquisitionTime", "ModifiedSeriesNumber"),
+        )
+
+    return dataset_list
+
+
+@pytest.fixture(scope="module")
+def organize_dataset():
+    return load_analyzer("organize_dataset", itemgetter=itemgetter)["organize_dataset"]
+
+
+def make_acquisition(rng, subject):
+    anonymized = rng.random() < 0.7
+    series_number = rng.randint(1, 8)
+    return {
+        "id": rng.random(),
+        # a few IDs sort among the pseudo subject IDs
+        "subject": rng.choice(["n/a"] * 8 + ["n/a0002", f"s{subject}"]),
+        "AcquisitionDateTime": (
+            "0000-00-00T00:00:00.000000" if anonymized else "2024-01-01T00:00:00.000000"
+        ),
+        "PatientID": "n/a" if anonymized else f"P{subject}",
+        "PatientName": "n/a",
+        "SeriesNumber": series_number,
+        # duplicated times and series numbers make acquisitions tie in the sort
+        "ModifiedSeriesNumber": f"{series_number:02d}",
+        "AcquisitionTime": rng.choice(
+            ["00:00:00.000000", f"{9 + subject % 3:02d}:{series_number:02d}:00"]
+        ),
+    }
+
+
+def assignments(function, dataset_list):
+    return [
+        (x["id"], x["subject"], x["AcquisitionDateTime"])
+        for x in function(copy.deepcopy(dataset_list))
+    ]
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_pseudo_subjects_match_previous_implementation(organize_dataset, seed):
+    rng = random.Random(seed)
+    dataset_list = [
+        make_acquisition(rng, subject=rng.randint(1, 6))
+        for _ in range(rng.randint(1, 80))
+    ]
+
+    assert assignments(organize_dataset, dataset_list) == assignments(
+        previous_organize_dataset, dataset_list
+    )
+
+
+def test_anonymized_subjects(organize_dataset):
+    # three anonymized subjects, each with series 1-5 at increasing times
+    dataset_list = [
+        {
+            "id": f"{subject}.{series_number}",
+            "subject": "n/a",
+            "AcquisitionDateTime": "0000-00-00T00:00:00.000000",
+            "PatientID": "n/a",
+            "PatientName": "n/a",
+            "SeriesNumber": series_number,
+            "ModifiedSeriesNumber": f"{series_number:02d}",
+            "AcquisitionTime": f"{8 + subject:02d}:0{series_number}",
+        }
+        for subject in range(3)
+        for series_number in range(1, 6)
+    ]
+
+    subjects = {x["id"]: x["subject"] for x in organize_dataset(dataset_list)}
+
+    # renamed acquisitions move behind the remaining n/a ones, so the acquisition an anonymized
+    # acquisition is compared with often isn't the one acquired before it
+    assert subjects == {
+        **{f"0.{x}": "n/a0001" for x in (1, 2, 3)},
+        **{f"0.{x}": "n/a0000" for x in (4, 5)},
+        **{f"1.{x}": "n/a0002" for x in (1, 2, 3, 4)},
+        "1.5": "n/a0001",
+        **{f"2.{x}": "n/a0003" for x in (1, 2, 3)},
+        **{f"2.{x}": "n/a0002" for x in (4, 5)},
+    }
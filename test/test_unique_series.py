@@ -0,0 +1,113 @@
+"""
+determine_unique_series looks series up in a dict keyed by their heuristic items, it must assign the
+same series_idx values as the list scans it replaced.
+"""
+
+import copy
+import random
+
+import pytest
+from scripts import load_analyzer
+
+
+def previous_determine_unique_series(dataset_list, bids_compliant):
+    """
+    determine_unique_series before the keyed lookup (non BIDS-compliant uploads only).
+    """
+    dataset_list_unique_series = []
+    series_checker = []
+    series_idx = 0
+
+    for index, acquisition_dic in enumerate(dataset_list):
+        descriptor = acquisition_dic["descriptor"]
+        if "_RR" in acquisition_dic["SeriesDescription"]:
+            heuristic_items = [
+                round(acquisition_dic["EchoTime"], 1),
+                acquisition_dic[descriptor].replace("_RR", ""),
+                acquisition_dic["ImageType"],
+                round(acquisition_dic["RepetitionTime"], 1),
+            ]
+        else:
+            heuristic_items = [
+                round(acquisition_dic["EchoTime"], 1),
+                acquisition_dic[descriptor],
+                acquisition_dic["ImageType"],
+                round(acquisition_dic["RepetitionTime"], 1),
+            ]
+
+        if index == 0:
+            acquisition_dic["series_idx"] = 0
+            dataset_list_unique_series.append(acquisition_dic)
+        else:
+            if heuristic_items[1:3] not in [x[1:3] for x in series_checker]:
+                series_idx += 1
+                acquisition_dic["series_idx"] = series_idx
+                dataset_list_unique_series.append(acquisition_dic)
+            else:
+                if heuristic_items not in [x[:-1] for x in series_checker]:
+                    series_idx += 1
+                    acquisition_dic["series_idx"] = series_idx
+                    dataset_list_unique_series.append(acquisition_dic)
+                else:
+                    common_series_index = [x[:-1] for x in series_checker].index(
+                        heuristic_items
+                    )
+                    common_series_idx = series_checker[common_series_index][-1]
+                    acquisition_dic["series_idx"] = common_series_idx
+
+        series_checker.append(heuristic_items + [acquisition_dic["series_idx"]])
+
+    return dataset_list, dataset_list_unique_series
+
+
+@pytest.fixture(scope="module")
+def determine_unique_series():
+    return load_analyzer("determine_unique_series")["determine_unique_series"]
+
+
+def make_acquisition(rng):
+    sd = rng.choice(["T1w_MPR", "T1w_MPR_RR", "rest_bold", "dwi_AP"])
+    return {
+        "descriptor": rng.choice(["SeriesDescription", "ProtocolName"]),
+        "SeriesDescription": sd,
+        "ProtocolName": rng.choice([sd, sd.replace("_RR", ""), "localizer"]),
+        # close values round to the same tenth, distant ones don't
+        "EchoTime": rng.choice([0.002, 0.0021, 0.03, 0.031, 1.0]),
+        "RepetitionTime": rng.choice([2.0, 2.04, 2.3, 0.8]),
+        "ImageType": rng.choice(
+            [
+                ["ORIGINAL", "PRIMARY", "M"],
+                ["ORIGINAL", "PRIMARY", "P"],
+                ["DERIVED", "PRIMARY", "M", "MOCO"],
+            ]
+        ),
+    }
+
+
+def series_indices(function, dataset_list, bids_compliant=False):
+    dataset_list, unique_series = function(copy.deepcopy(dataset_list), bids_compliant)
+    return [x["series_idx"] for x in dataset_list], [
+        dataset_list.index(x) for x in unique_series
+    ]
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_series_idx_matches_previous_implementation(determine_unique_series, seed):
+    rng = random.Random(seed)
+    dataset_list = [make_acquisition(rng) for _ in range(rng.randint(1, 60))]
+
+    assert series_indices(determine_unique_series, dataset_list) == series_indices(
+        previous_determine_unique_series, dataset_list
+    )
+
+
+def test_bids_compliant_acquisitions_are_each_a_series(determine_unique_series):
+    rng = random.Random(0)
+    dataset_list = [make_acquisition(rng) for _ in range(20)]
+
+    series_idx, unique_series = series_indices(
+        determine_unique_series, dataset_list, bids_compliant=True
+    )
+
+    assert series_idx == list(range(20))
+    assert unique_series == list(range(20))